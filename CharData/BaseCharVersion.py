@@ -26,7 +26,7 @@ do not edit the data source object directly, but through methods provided by Bas
 from __future__ import annotations
 from datetime import datetime, timezone
 from typing import List, Optional, Union, Any, Tuple, Generator, Iterable, Callable, TypeVar, Dict, Iterator, Final, TYPE_CHECKING, ClassVar
-from functools import wraps
+from functools import wraps, lru_cache
 import itertools
 
 from . import Regexps
@@ -111,6 +111,38 @@ def invert_key_at_wildcard(key: str) -> List[str]:
     return split_key
 
 
+@lru_cache(maxsize=4096)
+def _lookup_keys(query: str, restricted: bool) -> Tuple[str, ...]:
+    """
+    Helper function for BaseCharVersion.lookup_candidates.
+    Returns the tuple of search keys for query in order of precedence, without the data source indices.
+    The same keys are looked up repeatedly (in every data source and on every evaluation), so we cache these.
+    """
+    split_key = query.split('.')
+    keylen = len(split_key)
+    assert keylen > 0
+    main_key = split_key[keylen-1]
+    ret = []
+
+    for i in range(keylen-1, -1, -1):
+        # prefix = ".".join(split_key[0:i])
+        search_key = ".".join(split_key[0:i] + [main_key])
+        if restricted and not Regexps.re_key_restrict.fullmatch(search_key):
+            # In restricted mode, we only yield restricted search keys.
+            # Note that if search_key is not restricted, all further search keys won't be either, so we break.
+            break
+        ret.append(search_key)
+        if main_key == _ALL_SUFFIX:
+            continue
+        search_key = ".".join(split_key[0:i] + [_ALL_SUFFIX])
+        if restricted and not Regexps.re_key_restrict.fullmatch(search_key):
+            # Same as above, but if search_key is not restricted, further search keys may become restricted again.
+            # (This happens if the main_key part causes search_key to be restricted)
+            continue
+        ret.append(search_key)
+    return tuple(ret)
+
+
 class BaseCharVersion:
     """
     This class models a version of a given character. It (or rather, some derived classes) also acts as the interface
@@ -171,6 +203,9 @@ class BaseCharVersion:
     _type_lookup: dict = {}  # first index of data source for a given dict_type
     _desc_lookup: dict = {}  # first index of data source for a given description
     _default_target: Optional[int] = None  # index that writes go by default
+    # Memo of results of self.get(query) during evaluation of a formula. This is a dict while evaluating and None
+    # otherwise. It is only set on the instance and only for the duration of the outermost evaluation, see self.get.
+    _lookup_cache: Optional[dict] = None
 
     _config: Optional[CVConfig]  # TODO: May remove Optional if direct data_sources interface goes away.
     # Important: Access to members of _config needs to go through self.config, not self._config
@@ -577,6 +612,17 @@ class BaseCharVersion:
                         (in the form of a DataError object, not by raising an exception)
         :return: database entry or DataError (as return type, not raised) if key is not found.
         """
+        # While evaluating a formula, plain lookups get(query) are memoized, as formulas often refer to the same
+        # keys multiple times (possibly indirectly). This is valid because evaluation does not modify any data and the
+        # result of get(query) only depends on query if locator and default are not set.
+        # The memo only lives for the duration of the outermost evaluation, so we never see stale data.
+        cacheable = locator is None and default is None
+        if cacheable and self._lookup_cache is not None:
+            try:
+                return self._lookup_cache[query]
+            except KeyError:
+                pass
+
         if locator is None:
             # print('Calling with ' + query + ' empty locator')
             # This creates a generator that yields all matches for the query key according to our lookup rules.
@@ -622,12 +668,20 @@ class BaseCharVersion:
             # if Parser.CONTINUE_LOOKUP in needs_env:
             #     context[Parser.CONTINUE_LOOKUP] = list(locator_iterator)
             assert needs_env <= context.keys()
+            outermost = self._lookup_cache is None
+            if outermost:
+                self._lookup_cache = {}
             try:
                 ret = ret.eval_ast(self, context)
             except Exception as e:  # TODO: More fine-grained error handling
                 if isinstance(e, AssertionError):
                     raise
                 ret = CharExceptions.DataError("Error evaluating " + located_key, exception=e)  # TODO: Keep exception?
+            finally:
+                if outermost:
+                    self._lookup_cache = None
+        if cacheable and self._lookup_cache is not None:
+            self._lookup_cache[query] = ret
         return ret
 
     # TODO: Redo lookup
@@ -665,30 +719,9 @@ class BaseCharVersion:
             else:
                 indices = self._unrestricted_lists
 
-        split_key = query.split('.')
-        keylen = len(split_key)
-        assert keylen > 0
-        main_key = split_key[keylen-1]
-
-        for i in range(keylen-1, -1, -1):
-            # prefix = ".".join(split_key[0:i])
-            search_key = ".".join(split_key[0:i] + [main_key])
-            if restricted and not Regexps.re_key_restrict.fullmatch(search_key):
-                # In restricted mode, we only yield restricted search keys.
-                # Note that if search_key is not restricted, all further search keys won't be either, so we break.
-                break
-            for j in indices:
-                yield search_key, j
-            if main_key == _ALL_SUFFIX:
-                continue
-            search_key = ".".join(split_key[0:i] + [_ALL_SUFFIX])
-            if restricted and not Regexps.re_key_restrict.fullmatch(search_key):
-                # Same as above, but if search_key is not restricted, further search keys may become restricted again.
-                # (This happens if the main_key part causes search_key to be restricted)
-                continue
+        for search_key in _lookup_keys(query, restricted):
             for j in indices:
                 yield search_key, j
-        return
 
     def function_candidates(self, query: str, *, indices: Iterable[int] = None) -> Generator[Tuple[str, int], None, None]:
         """
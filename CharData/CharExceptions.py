@@ -21,6 +21,7 @@ class DataError:
     """
     Used to indicate that a database entry is faulty.
     Reason is the reason, exception is possibly an exception that caused it (if present)
+    Do not subclass this: Some performance-critical code checks type(x) is DataError.
     """
     def __init__(self, reason: str = "", exception: Exception = None):
         self.exception = exception
@@ -6,16 +6,10 @@
     Note that the arguments to T.eval_ast are irrelevant for this particular example and that the user needs to input
     "=11+5", the initial "=" being consumed and used to determine this is to be parsed by this module at all.
 
-    We use PLY (Python lex/yacc) to build the parser.
-    Note that PLY makes extensive use of introspection, i.e. PLY analyzes the function definitions in this Parser.py
-    file and looks for functions whose names match certain patterns and extracts lexer/parser rules from its docstrings.
-
-    In particular, function names and docstrings carry actual semantics in this file!
-
-    The usual workflow is that an input string such as "11 + 5" is first tokenized by ply.lex into a list of tokens
+    The usual workflow is that an input string such as "11 + 5" is first tokenized into a list of tokens
     [("INT",11), ("+","+"), ("INT", 5)].
-    Next (the actual implementation of PLY interleaves tokenizing and parsing in some way),
-    ply.yacc generates an abstract syntax tree from this list of tokens.
+    Next (the actual implementation interleaves tokenizing and parsing), our (hand-written) parser generates an
+    abstract syntax tree from this list of tokens.
     In the given example, the tree would have a root node for "Addition operation" with 2 child leaves
     encoding "integer literal 11" and "integer literal 5".
     Each such node has an eval_ast function, where the children evaluate to 11 and 5. the root evaluates to 16.
@@ -36,16 +30,14 @@
 # actually match demand.
 
 from __future__ import annotations
-from typing import TYPE_CHECKING, Union, Final
-from itertools import chain
+from typing import TYPE_CHECKING, Union, Final, Callable, Any, Iterator
+from weakref import WeakValueDictionary
+from functools import lru_cache
+import copy
+import operator
+import threading
 
-import ply.lex as lex
-import ply.yacc as yacc
-# ply.lex.TOKEN is a decorator to associate regexps with tokenizer rules.
-# The "normal" way is to set a docstring to the regexp, which (apart from all the qualms I have about giving
-# docstrings semantics) does not work if, e.g. the regexp is an import such as re_key_any.
-# ply.lex.TOKEN avoids this limitation
-from ply.lex import TOKEN
+import re
 
 from .Regexps import re_key_any, re_number_float, re_number_int, re_argname, re_funcname, re_special_arg
 from .CharExceptions import DataError, CGParseException, CGEvalException
@@ -54,7 +46,7 @@ if TYPE_CHECKING:
     from . import BaseCharVersion
 
 # Recognized keywords by the tokenizer.
-# ply.lex generates tokens with a value and a type. For keywords in this list, value == type == keyword string.
+# The tokenizer generates tokens with a value and a type. For keywords in this list, value == type == keyword string.
 # keywords must be all-caps.
 
 keywords: Final = [
@@ -70,6 +62,7 @@ keywords: Final = [
     'THEN',
     'ELSE',
 ]
+_keyword_set: Final = frozenset(keywords)
 
 _EMPTYSET: Final = frozenset()
 
@@ -85,11 +78,11 @@ core_constants: Final = {
     'FALSE': False,
 }
 
-# tokens of the form $Name (with a literal $), where Name starts with a capital letter will be recognized by the lexer
-# iff(!) Name.upper() is in the special_args dict. Note that $foo (for lowercase foo) is recognized as a variable with
-# name foo (used in lambdas); special_args should be used for similar purposes, in particular for things that behave
-# like environmental variables that need to be set externally by the caller when actually evaluating. Or more generally,
-# things that are in some sense context-dependent.
+# tokens of the form $Name (with a literal $), where Name starts with a capital letter will be recognized by the
+# tokenizer iff(!) Name.upper() is in the special_args dict. Note that $foo (for lowercase foo) is recognized as a
+# variable with name foo (used in lambdas); special_args should be used for similar purposes, in particular for things
+# that behave like environmental variables that need to be set externally by the caller when actually evaluating. Or
+# more generally, things that are in some sense context-dependent.
 
 special_args: Final = {
     # keys are what is recognized as $Key (after uppercasing, so keys need to be capitalized here).
@@ -122,6 +115,8 @@ special_args: Final = {
 # (i.e. there is a special variable $Continue that is reserved for internal usage.)
 # It can not be used as a variable in lambdas (enforced by Continue being uppercase).
 CONTINUE_LOOKUP: Final = 'Continue'
+# sets of free variables of $AUTO - type tokens by the query name they use.
+_AUTO_ENVS: Final = {spec[1]: frozenset({CONTINUE_LOOKUP, spec[1]}) for spec in special_args.values() if spec[0] == 'AUTO'}
 
 # Parse results are abstract syntax trees, which may contain lambdas and (bound or free) variables $foo.
 # Every tree node knows which variables are free in its subtree.
@@ -129,7 +124,7 @@ CONTINUE_LOOKUP: Final = 'Continue'
 # Such escaping variables must then be set by the caller when evaluating the parse result.
 _ALLOWED_SPECIAL_ARGS = frozenset({'Name', 'Query', CONTINUE_LOOKUP})
 
-# PLY looks for a variable named tokens (and literals) to determine the set of tokens in its parsing rules later.
+# Token types. Besides these, one-character tokens such as '+' have the character itself as their type.
 tokens: Final = [
              'STRING',  # Quote - enclosed string
              'IDIV',  # // (integral division, as opposed to /, which gives floats)
@@ -147,104 +142,28 @@ tokens: Final = [
              'CORECONSTANT',  # hard-coded constants (which may be of type function)
          ] + keywords
 
-# one-character tokens such as '+' are defined in the special variable literals.
-
-# PLY.lex generates tokenizer rules from definitions with names t_foo(token) and the special variable named literals.
-# token.type determines the type of token we have (defaults to "foo" in t_foo definitions unless foo is a special name),
-# which is what our parser rules below refer to.
-# token.value is the actual payload of the token. (e.g. the actual number in a token of type "number"). Defaults to
-# the actual substring of the input that generated the regexp match.
-# Tokenizer matches are determined by regular expressions given by the docstring or @TOKEN decorator.
-# token.type must be either a literal or from the tokens list above. t_foo(token) function defs must return the
-# (possibly modified) token or None or raise an exception. If None is returned, the input substring is consumed without
-# generating a token for the parser.
-
-# Note: Order matters!
-# Function definitions take priority (in order of definition),
-# then t_TOKEN = regexp definitions (in order of decreasing length of regexp)
-# then literals
-
-
-# noinspection PySingleQuotedDocstring
-def t_STRING(token, /):  # strings delimited by either ' or " (left and right delimeters must match)
-    r"(?:'[^']*')|" r'(?:"[^"]*")'  # Allow either ' or " as delimeters (Python-like)
-    token.value = token.value[1:-1]  # strip the quotation marks already at the lexer stage
-    return token
-
-
-@TOKEN(re_number_float.pattern)  # floating numbers with a .
-def t_FLOAT(token, /):
-    token.value = float(token.value)
-    return token
-
-
-# This must come after t_FLOAT (so that e.g. the prefix "5" of 5.4 is not tokenized as an int)
-@TOKEN(re_number_int.pattern)  # integers
-def t_INT(token, /):
-    token.value = int(token.value)
-    return token
-
-
-# This is a single rule for
-# -Keywords OR AND NOT etc
-# -Functions FUNC
-# Special References $Name etc.
-# local variables $name
-# references to other data fields attr.strength
-# These are pooled as a single t_WORD rule in order to ensure that strings such as Ab do not parse as separate tokens
-# A and b. This way we get an error "Did not recognize string Ab" instead of a mis-parse or a confusing error.
-# Note that no tokens of actual type "WORD" exist: we always overwrite token.type
-# noinspection PySingleQuotedDocstring
-def t_WORD(token, /):
-    r"[$]?[a-z._A-Z]+"  # We match any combination of letters, dots and underscores that optionally starts with $
-    if token.value in core_constants:
-        token.type = 'CORECONSTANT'
-    elif re_special_arg.fullmatch(token.value):  # r"[$][A-Z][a-zA-Z_]*" : Tokens of the Form $Foo or $FOO
-        # We only accept if FOO is from the special_args dict above, which contains (type,value) as special_args['FOO']
-        try:
-            spec = special_args[token.value[1:].upper()]  # [1:] strips the leading $
-        except KeyError:
-            raise SyntaxError("Invalid argument name " + token.value)
-        else:
-            token.type = spec[0]
-            token.value = spec[1]
-    elif re_argname.fullmatch(token.value):  # r"[$][a-z_]+" : Tokens of the form $foo: internal variable names
-        token.type = 'ARGNAME'
-        token.value = token.value[1:]  # strip leading $
-    elif re_funcname.fullmatch(token.value):  # "[A-Z]+": Function names and keywords are ALLCAPS. Allow _'s ?
-        token.type = 'FUNCNAME'
-        if token.value in keywords:
-            token.type = token.value
-        if token.value == 'LAMBDA':  # special-cased, because we don't need separate token.type = 'LAMBDA' type.
-            token.type = 'FUN'
-    elif re_key_any.fullmatch(token.value):  # complicated regexp, matching lookups attr.strength etc.
-        token.type = 'LOOKUP'
-    else:
-        raise SyntaxError("Did not recognize String " + token.value)
-    return token
-
-
-# This is called by PLY.lex in case of tokenizer errors, i.e. when no rule matches a prefix of the remaining input.
-def t_error(token, /):
-    # for now, sets the remaining input string as empty: we are done parsing.
-    # Otherwise, we risk an endless loop if the exception is handled and parsing continues.
-    token.lexer.input("")
-    raise SyntaxError("Could not parse formula")
-
-
-# t_ignore is a list of characters that are simply ignored by the parser (unless part of a match before,
-# e.g. whitespace in string literals), but may act as separators.
-t_ignore = ' \t\n\r\f\v'  # ignore (ASCII) whitespace. We complain about Non-Ascii unicode whitespace.
-
-# t_foo = string specifications and literals take precedence in order of length. So "//" will match IDIV rather than "/" twice.
-t_IDIV = r"//"
-t_EQUALS = r"=="
-t_NEQUALS = r"!="
-t_LTE = r"<="
-t_GTE = r">="
-
-# literals will generate single literal tokens
-literals = "+-*/%()[],<>={}:"
+
+class _Token:
+    """
+    Token produced by the tokenizer. type is the token type (see tokens above), value is its payload (e.g. the actual
+    number for a token of type INT). Tokens are never modified, so equal tokens are shared where possible.
+    """
+    __slots__ = ['type', 'value']
+
+    def __init__(self, token_type: str, value, /):
+        self.type = token_type
+        self.value = value
+
+
+# The tokenizer matches a single regular expression at the current position, which has one named group per kind of
+# token. Whitespace (ASCII only; we complain about non-ASCII unicode whitespace) before the token is part of the match.
+# Note: Order matters! The first alternative that matches is taken. So e.g. 5.4 is a FLOAT rather than the INT 5.
+# - Strings are delimited by either ' or " (left and right delimiters must match, Python-like).
+# - Words are any combination of letters, dots and underscores that optionally starts with $. This is a single
+#   alternative for keywords, function names, special arguments, variables and lookups, which we distinguish afterwards
+#   in _classify_word. This ensures that strings such as Ab do not get tokenized as separate tokens A and b. This way
+#   we get an error "Did not recognize string Ab" instead of a mis-parse or a confusing error.
+# - Operators consisting of two characters come before the one-character ones, so // is IDIV rather than '/' twice.
 # Note: While we have [] for indexing into iterables, membership access via "." is missing intentionally!
 # In fact, allowing this might give remote code execution. The issue is that python objects carry references to
 # their definition context via __globals__, __module__ etc. and these would become accessible.
@@ -252,9 +171,84 @@ literals = "+-*/%()[],<>={}:"
 # Since cookies may contain (supposedly signed) pickled python objects, an attacker can hijack pickle for remote code
 # execution.
 # Less maliciously, standard python types expose mutating functions such as list.append that we do not wish to be callable.
-
-# use PLY.lex to actually generate the lexer now.
-lexer = lex.lex()
+_WHITESPACE: Final = ' \t\n\r\f\v'
+_token_regexp: Final = re.compile(
+    '[' + _WHITESPACE + ']*(?:'
+    r"""(?P<STRING>'[^']*'|"[^"]*")"""
+    '|(?P<FLOAT>' + re_number_float.pattern + ')'
+    '|(?P<INT>' + re_number_int.pattern + ')'
+    r'|(?P<WORD>[$]?[a-z._A-Z]+)'
+    r'|(?P<OPERATOR>//|==|!=|<=|>=|[-+*/%()\[\],<>={}:])'
+    ')')
+
+_operator_tokens: Final = {'//': _Token('IDIV', '//'), '==': _Token('EQUALS', '=='), '!=': _Token('NEQUALS', '!='),
+                           '<=': _Token('LTE', '<='), '>=': _Token('GTE', '>=')}
+_operator_tokens.update({char: _Token(char, char) for char in "+-*/%()[],<>={}:"})
+
+
+# Classification of words is cached, since the same words (keys such as attr.strength, variables, keywords) appear in
+# many formulas and most tokens are words. Note that invalid words raise and are not cached.
+@lru_cache(maxsize=4096)
+def _classify_word(word: str, /) -> _Token:
+    """
+    :return: token for a word matched by the WORD alternative of _token_regexp. Raises SyntaxError for invalid words.
+    """
+    if word in core_constants:
+        return _Token('CORECONSTANT', word)
+    # The first (two) characters determine which kind of word this can be, so we only need to check one regexp.
+    first = word[0]
+    if first == '$':
+        second = word[1:2]
+        if 'A' <= second <= 'Z':
+            if re_special_arg.fullmatch(word):  # r"[$][A-Z][a-zA-Z_]*" : Tokens of the Form $Foo or $FOO
+                # We only accept if FOO is from the special_args dict above, which contains (type,value) as
+                # special_args['FOO']
+                try:
+                    spec = special_args[word[1:].upper()]  # [1:] strips the leading $
+                except KeyError:
+                    raise SyntaxError("Invalid argument name " + word)
+                else:
+                    return _Token(spec[0], spec[1])
+        elif re_argname.fullmatch(word):  # r"[$][a-z_]+" : Tokens of the form $foo: internal variable names
+            return _Token('ARGNAME', word[1:])  # strip leading $
+    elif 'A' <= first <= 'Z':
+        if re_funcname.fullmatch(word):  # "[A-Z]+": Function names and keywords are ALLCAPS. Allow _'s ?
+            if word == 'LAMBDA':  # special-cased, because we don't need separate token.type = 'LAMBDA' type.
+                return _Token('FUN', word)
+            if word in _keyword_set:
+                return _Token(word, word)
+            return _Token('FUNCNAME', word)
+    elif re_key_any.fullmatch(word):  # complicated regexp, matching lookups attr.strength etc.
+        return _Token('LOOKUP', word)
+    raise SyntaxError("Did not recognize String " + word)
+
+
+def _tokenize(input_string: str, /) -> Iterator[_Token]:
+    """
+    Yields the tokens of input_string. Raises SyntaxError on invalid input.
+    Tokens are produced lazily, i.e. only when the parser requests them.
+    """
+    end = len(input_string.rstrip(_WHITESPACE))
+    match = _token_regexp.match
+    pos = 0
+    while pos < end:
+        token_match = match(input_string, pos)
+        if token_match is None:
+            raise SyntaxError("Could not parse formula")
+        pos = token_match.end()
+        kind = token_match.lastgroup
+        text = token_match[kind]
+        if kind == 'WORD':
+            yield _classify_word(text)
+        elif kind == 'OPERATOR':
+            yield _operator_tokens[text]
+        elif kind == 'INT':
+            yield _Token('INT', int(text))
+        elif kind == 'FLOAT':
+            yield _Token('FLOAT', float(text))
+        else:
+            assert kind == 'STRING'
+            yield _Token('STRING', text[1:-1])  # strip the quotation marks already at the tokenizer stage
 
 
 # We parse the input string into an abstract syntax tree object of type (derived from) AST.
@@ -263,6 +257,7 @@ lexer = lex.lex()
 # actual derived class determines the type of object.
 # (e.g. AST_Sum for an addition, AST_Mult for a multiplication)
 # t's children are stored in t.child[0], ...
+# (Nodes with a fixed number of children additionally store them under names such as t.left, t.right for faster access)
 # The classvariable typedesc is a string denoting the type of operation.
 # It is only used for printing (which in turn is only for debugging)
 # ASTs are the result from parsing the input string.
@@ -271,10 +266,24 @@ lexer = lex.lex()
 # Furthermore, the structure of ASTs ist such that it should be easy to serialize them.
 
 # To actually evaluate the AST instance T, call T.eval_ast(data_list, context)
+# (Internally, every AST node is compiled into a Python function T.evaluator(data_list, context) when first evaluated.
+# For leaves and some rarely used nodes, this is a closure that directly calls the functions of its children.
+# For operators, conditionals, containers and plain function calls, we instead generate Python source code for the
+# whole subtree, which is compiled by Python's own compiler (see _CodeGenerator). The result evaluates the subtree in a
+# single function with local variables for intermediate results, which is several times faster than calling one
+# closure per node. Derived classes implement _compile and/or _generate for that.)
+# Errors during evaluation are usually returned as DataError objects rather than raised. The evaluators check for these
+# with type(x) is DataError, which is noticeably faster than isinstance and equivalent, since DataError has no
+# subclasses.
 # data_list is the list of data sources, used to evaluate (database) references.
 # context is a dict for variables $arg = value that may appear.
 # External callers should usually only set $Name and $Query.
 # (context is mostly used internally to implement lambdas INSIDE ASTs. Externally set args are capitalized)
+# Inside the body of a lambda, context is not a dict, but rather a frame, i.e. a tuple or list of values. Frames are
+# laid out when the AST_Lambda is constructed: first come the values of the lambda's free variables (captured when the
+# lambda is defined), then one slot per named argument. Variable references inside the body are resolved to integer
+# indices into that frame at construction time (see AST._rebind), so evaluating a lambda never copies or hashes into
+# a dict. Either way, nodes only ever access context[key], where key is a name at the top level or a frame index.
 
 # For function definitions and function call expressions, we have the following non-obvious choices:
 
@@ -283,7 +292,13 @@ lexer = lex.lex()
 # For a function call f(a, *b,**c, $name  = d), we have an AST_FunctionCall node with children f,a,b,c,d.
 # The subclass of AST of a,b,c do not tell that this a *,** or namebind-expression:
 # This information is *not* part of the AST's tree structure. (there is no AST subclass for "star-expression" etc.)
-# Rather, a,b,c,d have an object variable a.argtype denoting "starred-ness" and optionally d.argname = "name".
+# Rather, the AST_FunctionCall node has a tuple argkinds with one (argtype, namebind) - pair per argument, where argtype
+# denotes "starred-ness" and namebind is "name" for d and None otherwise.
+# (We do not store this on a,b,c,d themselves, since ASTs are immutable and leaves may be shared, see below)
+
+# ASTs are never modified after construction. This allows us to share subtrees: Leaves (literals, lookups, variables)
+# are interned, i.e. constructing a leaf that is equal to an existing one returns the existing object.
+# Formulas such as attr.strength or 1 appear very often in a character sheet, so this saves memory and allocations.
 
 # For a function definition FUN[$a,$b,*$c]($a+$b), we have an AST_LAMBDA. AST_Lambdas always have exactly 2 children:
 # The right child is an AST for the function body ($a+$b in this example). The left child is *not* an AST, but
@@ -291,6 +306,24 @@ lexer = lex.lex()
 # whether there is a default argument) and optionally default argument (which is an AST).
 
 
+# Sets of free variables (needs_env below) are frozensets. Since only few distinct such sets appear, we share equal sets
+# rather than creating new ones for each AST node.
+@lru_cache(maxsize=1024)
+def _interned_env(env: frozenset, /) -> frozenset:
+    """
+    :return: a frozenset equal to env. For equal inputs, we return the same object (unless evicted from the cache).
+    """
+    return env
+
+
+@lru_cache(maxsize=1024)
+def _variable_env(name: str, /) -> frozenset:
+    """
+    :return: the set {name} of free variables of an AST consisting only of the variable $name.
+    """
+    return _interned_env(frozenset({name}))
+
+
 class AST:
     """
     Abstract syntax tree class. Actual objects are from derived classes.
@@ -298,8 +331,14 @@ class AST:
     Use eval_ast(data_list, context) to evaluate the AST.
     needs_env contains the set of (possibly implicit) free variables in the subtree.
     """
+    # Formulas are kept in memory as ASTs, so we use __slots__ to keep them small. Derived classes need to list
+    # their attributes in __slots__ as well. _evaluator holds the compiled evaluator, see below.
+    __slots__ = ['child', 'needs_env', '_evaluator', '__weakref__']
     typedesc = 'AST'  # for debug printing. Should never be used on parent class.
-    needs_env = _EMPTYSET  # default if need_env is never set for a particular object.
+    # Whether the code generated by self._generate may give a DataError. If not, generated code skips the check for it.
+    # Note that this need not hold for self.evaluator: e.g. the generated code for [a.b] returns a DataError for a.b
+    # from the enclosing function right away, whereas the evaluator of [a.b] returns it as its result.
+    may_return_error = True
 
     def __init__(self, *kw, needs_env=None):
         """ Default constructor for AST nodes. Collect and stores the arguments as child nodes
@@ -314,14 +353,44 @@ class AST:
         # TODO: Check if last statement in docstring is still true.
         self.child = kw
         if needs_env is None:
-            self.needs_env = frozenset(chain.from_iterable(map(lambda x: x.needs_env, kw)))
-            # self.needs_env = _EMPTYSET.union(*[x.needs_env for x in kw])
+            # Most subtrees have no free variables at all and otherwise usually only one child has any, so we avoid
+            # creating new frozensets in these cases.
+            child_envs = [x.needs_env for x in kw if x.needs_env]
+            if not child_envs:
+                self.needs_env = _EMPTYSET
+            elif len(child_envs) == 1:
+                self.needs_env = child_envs[0]
+            else:
+                self.needs_env = _interned_env(_EMPTYSET.union(*child_envs))
         else:
             self.needs_env = needs_env
 
     def __str__(self, /):  # Debug only, may be overridden in leaf nodes. Note that self.typedesc is always overridden.
         return self.typedesc + '[' + ", ".join([str(x) for x in self.child]) + ']'
 
+    def __getstate__(self):
+        # The compiled evaluator (see below) is neither copied nor serialized. Copies made by _rebind need a new one.
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name != '_evaluator' and name != '__weakref__' and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return None, state
+
+    def _rebind(self, scope: dict, /) -> AST:
+        """
+        Returns an AST that is equivalent to self, but where every free variable $name is looked up as
+        context[scope[name]] rather than context[name] upon evaluation. This is used by AST_Lambda to resolve variables
+        in the lambda's body to indices into its frame. self is never modified (subtrees may be shared), so we return
+        a modified copy where needed.
+        :param scope: dict mapping the names of (at least) all variables in self.needs_env to their new key.
+        """
+        if not self.needs_env:
+            return self
+        ret = copy.copy(self)
+        ret.child = tuple([c._rebind(scope) for c in self.child])
+        return ret
+
     def eval_ast(self, data_list: BaseCharVersion, context: dict):
         """
         evaluates the ast within the given context.
@@ -331,9 +400,162 @@ class AST:
 
         :param data_list: List of data sources used for lookups. Of type BaseCharVersion or None.
         :param context: Dict of variables used in evaluations. External callers need to supply those in self.needs_env.
+                        (Internally, this may be a frame of a lambda instead, see above)
         :return: result of evaluation.
         """
-        raise NotImplementedError()  # pure virtual method
+        return self.evaluator(data_list, context)
+
+    @property
+    def evaluator(self) -> Callable[[BaseCharVersion, Any], Any]:
+        """
+        Function evaluator(data_list, context) that is equivalent to self.eval_ast. Created on first use.
+        """
+        try:
+            return self._evaluator
+        except AttributeError:
+            self._evaluator = self._compile()
+            return self._evaluator
+
+    def _compile(self) -> Callable[[BaseCharVersion, Any], Any]:
+        """
+        Creates the function for self.evaluator. By default, we generate code for the subtree rooted at self.
+        Derived classes need to override this or _generate.
+        """
+        return _CodeGenerator().make_function(self)
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        """
+        Emits code that evaluates self into gen and returns a Python expression (a variable name) for the result.
+        The expression must not be used more than once. By default, we call self.evaluator.
+        """
+        return gen.call(self.evaluator)
+
+
+# Maximal nesting depth of blocks in generated code. Python's tokenizer only supports 100 levels of indentation.
+# Subtrees nested deeper than that get a function of their own.
+_MAX_GENERATED_INDENT: Final = 50
+
+
+class _CodeGenerator:
+    """
+    Generates the Python source code of a function evaluate(data_list, context) for an AST. Nodes emit their code via
+    AST._generate. Intermediate results are stored in local variables t1, t2, ... Other objects (values of literals and
+    evaluators of nodes that do not support code generation) are passed to the function as globals c1, c2, ...
+    As for the other evaluators, a DataError as the value of a subexpression is the result of the whole expression,
+    unless the subexpression is a branch that is not taken. Since this holds for every enclosing node, the generated
+    code simply returns DataErrors from the function as soon as it encounters them.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.indent = 1
+        self.namespace = {'DataError': DataError}
+        self.counter = 0
+
+    def new_name(self, prefix: str = 't', /) -> str:
+        self.counter += 1
+        return prefix + str(self.counter)
+
+    def emit(self, line: str, /) -> None:
+        self.lines.append('    ' * self.indent + line)
+
+    def constant(self, value, /) -> str:
+        """
+        :return: a Python expression with the given value.
+        """
+        # We do not write literals such as 1 into the code: This way, the code only depends on the shape of the AST and
+        # can be shared via _compile_source. Also, Python's compiler would warn about e.g. 1[0] or 1(0).
+        name = self.new_name('c')
+        self.namespace[name] = value
+        return name
+
+    def assign(self, expression: str, /) -> str:
+        """
+        Emits code that stores the value of expression in a new variable and returns the variable's name.
+        """
+        name = self.new_name()
+        self.emit(name + ' = ' + expression)
+        return name
+
+    def call(self, evaluator: Callable[[BaseCharVersion, Any], Any], /) -> str:
+        return self.assign(self.constant(evaluator) + '(data_list, context)')
+
+    # Note that generating code recurses over the AST, so we avoid unneeded calls in between (e.g. to a common method
+    # for the check on indentation below) to not hit the recursion limit for deeply nested formulas. (Long chains of
+    # operators, which are the common case of deep ASTs, are generated in a loop, see AST_BinOp and AST_And)
+
+    def checked_value(self, ast: AST, /) -> str:
+        """
+        Emits code that evaluates ast and returns an expression for the result.
+        If the result is a DataError, the generated function returns it.
+        """
+        if self.indent > _MAX_GENERATED_INDENT:
+            result = self.call(ast.evaluator)
+            # may_return_error only describes the code from ast._generate, so we always check here.
+            self.emit('if type(%s) is DataError: return %s' % (result, result))
+            return result
+        result = ast._generate(self)
+        if ast.may_return_error:
+            self.emit('if type(%s) is DataError: return %s' % (result, result))
+        return result
+
+    def branch(self, target: str, ast: AST, /) -> None:
+        """
+        Emits an indented block that evaluates ast and stores the result (which may be a DataError) in target.
+        """
+        self.indent += 1
+        if self.indent > _MAX_GENERATED_INDENT:
+            self.emit(target + ' = ' + self.call(ast.evaluator))
+        else:
+            self.emit(target + ' = ' + ast._generate(self))
+        self.indent -= 1
+
+    def make_function(self, ast: AST, /) -> Callable[[BaseCharVersion, Any], Any]:
+        self.emit('return ' + ast._generate(self))
+        source = 'def evaluate(data_list, context):\n' + '\n'.join(self.lines) + '\n'
+        exec(_compile_source(source), self.namespace)
+        return self.namespace['evaluate']
+
+
+@lru_cache(maxsize=1024)
+def _compile_source(source: str, /):
+    """
+    Compiles generated code. Compiling is much slower than evaluating the result, but formulas in a character sheet
+    mostly have only few different shapes (such as attr.strength + 1 and skill.perception + 2), which share their code.
+    """
+    return compile(source, '<formula>', 'exec')
+
+
+# Interned leaves. The keys are (class, key) pairs, where key is given by the class' _intern_key. Entries are removed
+# automatically once the leaf is no longer used anywhere.
+_interned_leaves: WeakValueDictionary = WeakValueDictionary()
+
+
+class _InternedLeaf(AST):
+    """
+    Base class for leaves that are interned: constructing a leaf with the same arguments as an existing one returns
+    the existing object. Derived classes need to set _intern_key and __getnewargs_ex__ (the latter for copy / pickle).
+    Note that __init__ is run again on the returned object; it must only set the same values again.
+    """
+    __slots__ = []
+
+    @staticmethod
+    def _intern_key(*args, **kwargs):
+        """
+        :return: hashable key determining the object constructed from args, kwargs or None if we should not intern.
+        """
+        raise NotImplementedError()
+
+    def __new__(cls, *args, **kwargs):
+        key = cls._intern_key(*args, **kwargs)
+        if key is None:
+            return super().__new__(cls)
+        key = (cls, key)
+        ret = _interned_leaves.get(key)
+        if ret is None:
+            ret = super().__new__(cls)
+            _interned_leaves[key] = ret
+        return ret
 
 
 class AST_BinOp(AST):
@@ -342,291 +564,589 @@ class AST_BinOp(AST):
     This class merely does error propagation (Error op anything == anything op Error == Error)
     common to all binary operations op.
     """
+    __slots__ = ['left', 'right']
     typedesc = 'Binary Op'  # should never be used.
 
-    def eval_ast(self, data_list, context: dict):
-        left = self.child[0].eval_ast(data_list, context)
-        if isinstance(left, DataError):
-            return left
-        right = self.child[1].eval_ast(data_list, context)
-        if isinstance(right, DataError):
-            return right
-        return self.eval_fun(left, right)
+    def __init__(self, left: AST, right: AST, /):
+        super().__init__(left, right)
+        # The operands are also stored as self.left and self.right (in addition to self.child) for faster access.
+        self.left = left
+        self.right = right
+
+    def _rebind(self, scope: dict, /) -> AST_BinOp:
+        if not self.needs_env:
+            return self
+        return self.__class__(self.left._rebind(scope), self.right._rebind(scope))
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        # Left-associative operators give left-leaning trees for chains such as a + b + c + ... We walk down the left
+        # operands in a loop rather than recursing, so long chains do not hit the recursion limit.
+        chain = [self]
+        left = self.left
+        while isinstance(left, AST_BinOp):
+            chain.append(left)
+            left = left.left
+        result = gen.checked_value(left)
+        for node in reversed(chain):
+            right = gen.checked_value(node.right)
+            result = gen.assign(node._python_expression(result, right))
+            if node is not self and node.may_return_error:  # The check for self is done by our caller.
+                gen.emit('if type(%s) is DataError: return %s' % (result, result))
+        return result
+
+    def _python_expression(self, left: str, right: str, /) -> str:
+        """
+        :return: Python expression for eval_fun applied to the Python expressions left and right.
+        """
+        return left + ' ' + self.python_operator + ' ' + right
 
     @staticmethod
     def eval_fun(left, right, /):
         raise NotImplementedError()  # pure virtual
 
+    python_operator = None  # Python syntax for eval_fun in generated code. pure virtual
+
 
 # Ast classes for the actual binary operation that we support in our language come here.
+# eval_fun is the corresponding function from the operator module, which avoids a Python-level call per operation.
+# python_operator is the same operation as a Python operator, which is used for generated code.
 
 class AST_Sum(AST_BinOp):
+    __slots__ = []
     typedesc = '+'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left + right
+    eval_fun = staticmethod(operator.add)
+    python_operator = '+'
 
 
 class AST_Sub(AST_BinOp):
+    __slots__ = []
     typedesc = '-'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left - right
+    eval_fun = staticmethod(operator.sub)
+    python_operator = '-'
 
 
 class AST_Mult(AST_BinOp):
+    __slots__ = []
     typedesc = '*'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left * right
+    eval_fun = staticmethod(operator.mul)
+    python_operator = '*'
 
 
 class AST_Div(AST_BinOp):
+    __slots__ = []
     typedesc = '/'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left / right
+    eval_fun = staticmethod(operator.truediv)
+    python_operator = '/'
 
 
 class AST_IDiv(AST_BinOp):
+    __slots__ = []
     typedesc = '//'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left // right
+    eval_fun = staticmethod(operator.floordiv)
+    python_operator = '//'
 
 
 class AST_Mod(AST_BinOp):
+    __slots__ = []
     typedesc = '%'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left % right
+    eval_fun = staticmethod(operator.mod)
+    python_operator = '%'
 
 
 class AST_Equals(AST_BinOp):
+    __slots__ = []
     typedesc = '=='
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left == right
+    eval_fun = staticmethod(operator.eq)
+    python_operator = '=='
 
 
 class AST_NEquals(AST_BinOp):
+    __slots__ = []
     typedesc = '!='
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left != right
+    eval_fun = staticmethod(operator.ne)
+    python_operator = '!='
 
 
 class AST_GTE(AST_BinOp):
+    __slots__ = []
     typedesc = '>='
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left >= right
+    eval_fun = staticmethod(operator.ge)
+    python_operator = '>='
 
 
 class AST_GT(AST_BinOp):
+    __slots__ = []
     typedesc = '>'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left > right
+    eval_fun = staticmethod(operator.gt)
+    python_operator = '>'
 
 
 class AST_LTE(AST_BinOp):
+    __slots__ = []
     typedesc = '<='
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left <= right
+    eval_fun = staticmethod(operator.le)
+    python_operator = '<='
 
 
 class AST_LT(AST_BinOp):
+    __slots__ = []
     typedesc = '<'
 
-    @staticmethod
-    def eval_fun(left, right, /):
-        return left < right
+    eval_fun = staticmethod(operator.lt)
+    python_operator = '<'
 
 
 # for container[index] expressions.
 class AST_GetItem(AST_BinOp):
+    __slots__ = []
     typedesc = 'GetItem'
 
-    @staticmethod
-    def eval_fun(container, index, /):
-        return container[index]
+    eval_fun = staticmethod(operator.getitem)  # eval_fun(container, index)
+
+    def _python_expression(self, container: str, index: str, /) -> str:
+        return container + '[' + index + ']'
+
+
+# types of literals for which we evaluate operations at parse time. We exclude strings and other types, because e.g.
+# 'a' * 1000000000 would already allocate when parsing. Note that bool is included in int.
+_FOLDABLE_TYPES: Final = (int, float)
+# operations that we also evaluate at parse time if operands are strings. Their results are not larger than the
+# operands, which are part of the input. (Unlike 'a' * 1000000000 or '%01000000000d' % 1)
+_STRING_FOLDABLE_OPS: Final = frozenset([AST_Sum, AST_Equals, AST_NEquals, AST_GTE, AST_GT, AST_LTE, AST_LT,
+                                         AST_GetItem])
+
+
+def make_binop(op: type, left: AST, right: AST, /) -> AST:
+    """
+    Creates an AST for the binary operation op (a subclass of AST_BinOp) applied to left and right.
+    If both operands are numeric literals, we evaluate once at parse time and return an AST_Literal (constant folding).
+    The same holds for string literals and operations from _STRING_FOLDABLE_OPS.
+    Errors such as 1/0 or 'a' < 1 are not folded, so they still occur upon evaluation.
+    """
+    if isinstance(left, AST_Literal) and isinstance(right, AST_Literal) and (
+            (isinstance(left.value, _FOLDABLE_TYPES) and isinstance(right.value, _FOLDABLE_TYPES))
+            or (op in _STRING_FOLDABLE_OPS and (isinstance(left.value, str) or isinstance(right.value, str)))):
+        try:
+            return AST_Literal(op.eval_fun(left.value, right.value))
+        except (ArithmeticError, TypeError, LookupError):
+            pass
+    return op(left, right)
 
 
 # AST_And is not derived from AST_BinOp because of short-circuiting.
 class AST_And(AST):
+    __slots__ = ['left', 'right']
     typedesc = 'AND'
 
-    def eval_ast(self, data_list, context):
-        left = self.child[0].eval_ast(data_list, context)
-        if (not left) or isinstance(left, DataError):
-            return left
-        return self.child[1].eval_ast(data_list, context)
+    def __init__(self, left: AST, right: AST, /):
+        super().__init__(left, right)
+        self.left = left
+        self.right = right
+
+    def _rebind(self, scope: dict, /) -> AST_And:
+        if not self.needs_env:
+            return self
+        return AST_And(self.left._rebind(scope), self.right._rebind(scope))
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        # a AND b AND c is parsed as a AND (b AND c). We generate such chains as the flat sequence
+        # result = a; if result: result = b; if result: result = c
+        # rather than as nested blocks, so long chains neither nest deeply nor hit the recursion limit.
+        result = gen.new_name()
+        gen.emit(result + ' = ' + gen.checked_value(self.left))
+        right = self.right
+        while type(right) is AST_And:
+            gen.emit('if ' + result + ':')
+            gen.indent += 1
+            gen.emit(result + ' = ' + gen.checked_value(right.left))
+            gen.indent -= 1
+            right = right.right
+        gen.emit('if ' + result + ':')
+        gen.branch(result, right)
+        return result
 
 
 class AST_Or(AST):  # Not derived from AST_BinOp because of short-circuiting.
+    __slots__ = ['left', 'right']
     typedesc = 'OR'
 
-    def eval_ast(self, data_list, context):
-        left = self.child[0].eval_ast(data_list, context)
-        if left:  # including DataError objects.
-            return left
-        return self.child[1].eval_ast(data_list, context)
+    def __init__(self, left: AST, right: AST, /):
+        super().__init__(left, right)
+        self.left = left
+        self.right = right
+
+    def _rebind(self, scope: dict, /) -> AST_Or:
+        if not self.needs_env:
+            return self
+        return AST_Or(self.left._rebind(scope), self.right._rebind(scope))
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        # Chains a OR b OR c are generated as a flat sequence, see AST_And.
+        result = gen.new_name()
+        gen.emit(result + ' = ' + gen.checked_value(self.left))
+        right = self.right
+        while type(right) is AST_Or:
+            gen.emit('if not ' + result + ':')
+            gen.indent += 1
+            gen.emit(result + ' = ' + gen.checked_value(right.left))
+            gen.indent -= 1
+            right = right.right
+        gen.emit('if not ' + result + ':')
+        gen.branch(result, right)
+        return result
 
 
 class AST_Not(AST):
+    __slots__ = ['operand']
     typedesc = 'NOT'
+    may_return_error = False
+
+    def __init__(self, operand: AST, /):
+        super().__init__(operand)
+        self.operand = operand
+
+    def _rebind(self, scope: dict, /) -> AST_Not:
+        if not self.needs_env:
+            return self
+        return AST_Not(self.operand._rebind(scope))
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('not ' + gen.checked_value(self.operand))
+
+
+def _is_constant(ast: AST, /) -> bool:
+    """
+    :return: whether ast always evaluates to the same value, which we can get via ast.eval_ast(None, None).
+    """
+    return isinstance(ast, AST_Literal) or isinstance(ast, AST_CoreConstant)
+
+
+def make_and(left: AST, right: AST, /) -> AST:
+    """
+    Creates an AST for left AND right. If left is a constant, the result is either left or right.
+    """
+    if _is_constant(left):
+        if left.eval_ast(None, None):
+            return right
+        # Unbound variables in right should still give an error when parsing, see make_cond.
+        if not right.needs_env:
+            return left
+    return AST_And(left, right)
+
+
+def make_or(left: AST, right: AST, /) -> AST:
+    """
+    Creates an AST for left OR right. If left is a constant, the result is either left or right.
+    """
+    if _is_constant(left):
+        if not left.eval_ast(None, None):
+            return right
+        if not right.needs_env:
+            return left
+    return AST_Or(left, right)
 
-    def eval_ast(self, data_list, context):
-        arg = self.child[0].eval_ast(data_list, context)
-        if isinstance(arg, DataError):
-            return arg
-        return not arg
+
+def make_not(operand: AST, /) -> AST:
+    """
+    Creates an AST for NOT operand. NOT of a constant is evaluated at parse time.
+    """
+    if _is_constant(operand):
+        return AST_Literal(not operand.eval_ast(None, None))
+    return AST_Not(operand)
 
 
 # COND(condition, a, b) == condition ? a : b in the C programming language and encodes an if.
 # except for the error handling: if cond causes an error, the result is that error.
 # Otherwise, only one of a and b is evaluated (so an error in the non-evaluated branch is ignored)
 class AST_Cond(AST):
+    __slots__ = ['cond', 'true_branch', 'false_branch']
     typedesc = 'COND'
 
-    def eval_ast(self, data_list, context):
-        cond = self.child[0].eval_ast(data_list, context)
-        if isinstance(cond, DataError):
-            return cond
-        if cond:
-            return self.child[1].eval_ast(data_list, context)
+    def __init__(self, cond: AST, true_branch: AST, false_branch: AST, /):
+        super().__init__(cond, true_branch, false_branch)
+        self.cond = cond
+        self.true_branch = true_branch
+        self.false_branch = false_branch
+
+    def _rebind(self, scope: dict, /) -> AST_Cond:
+        if not self.needs_env:
+            return self
+        return AST_Cond(self.cond._rebind(scope), self.true_branch._rebind(scope), self.false_branch._rebind(scope))
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        cond = gen.checked_value(self.cond)
+        result = gen.new_name()
+        gen.emit('if ' + cond + ':')
+        gen.branch(result, self.true_branch)
+        gen.emit('else:')
+        gen.branch(result, self.false_branch)
+        return result
+
+
+class AST_CondLit(AST):
+    """ Abstract syntax tree (inner node) for COND(condition, a, b), where a and b are literals. The only child is the
+        condition, the values of a and b are stored in self.true_value and self.false_value.
+        This saves evaluating the branches via eval_ast. Use make_cond to construct conditionals.
+    """
+    __slots__ = ['cond', 'true_value', 'false_value']
+    typedesc = 'COND'
+    may_return_error = False
+
+    def __init__(self, cond: AST, true_value, false_value, /):
+        super().__init__(cond)
+        self.cond = cond
+        self.true_value = true_value
+        self.false_value = false_value
+
+    def __str__(self, /):
+        return self.typedesc + '[' + ", ".join([str(self.cond), str(self.true_value), str(self.false_value)]) + ']'
+
+    def _rebind(self, scope: dict, /) -> AST_CondLit:
+        if not self.needs_env:
+            return self
+        return AST_CondLit(self.cond._rebind(scope), self.true_value, self.false_value)
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        cond = gen.checked_value(self.cond)
+        return gen.assign(gen.constant(self.true_value) + ' if ' + cond + ' else ' + gen.constant(self.false_value))
+
+
+def make_cond(cond: AST, true_branch: AST, false_branch: AST, /) -> AST:
+    """
+    Creates an AST for COND(cond, true_branch, false_branch), specialized for some common cases:
+    If cond is a constant, we directly return the appropriate branch. If both branches are literals, we use AST_CondLit.
+    """
+    if _is_constant(cond):
+        if cond.eval_ast(None, None):
+            taken, dropped = true_branch, false_branch
         else:
-            return self.child[2].eval_ast(data_list, context)
+            taken, dropped = false_branch, true_branch
+        # Unbound variables in the dropped branch should still give an error when parsing, so we only reduce if
+        # the dropped branch does not contain any free variables that are not in the other branch.
+        if dropped.needs_env <= taken.needs_env:
+            return taken
+    if isinstance(true_branch, AST_Literal) and isinstance(false_branch, AST_Literal):
+        return AST_CondLit(cond, true_branch.value, false_branch.value)
+    return AST_Cond(cond, true_branch, false_branch)
 
 
-class AST_Literal(AST):
+class AST_Literal(_InternedLeaf):
     """ Abstract syntax tree object (leaf) for literals of arbitrary type.
         The literal object itself is stored in self.value
     """
+    __slots__ = ['value']
     typedesc = 'Literal'
-    needs_env = _EMPTYSET  # every object has this set as well, actually.
+    may_return_error = False
 
     def __init__(self, val, /):
-        super().__init__(needs_env=self.__class__.needs_env)
+        super().__init__(needs_env=_EMPTYSET)
         self.value = val
 
+    @staticmethod
+    def _intern_key(val, /):
+        # We include the type, because 1 == 1.0 == True. Floats are excluded, because 0.0 == -0.0 and nan != nan.
+        if type(val) is str or type(val) is int or type(val) is bool:
+            return type(val), val
+        return None
+
+    def __getnewargs_ex__(self):
+        return (self.value,), {}
+
     def __str__(self, /):
         return self.typedesc + '(' + str(self.value) + ')'
 
-    # noinspection PyUnusedLocal
-    def eval_ast(self, data_list, context):
-        return self.value
+    def _compile(self):
+        value = self.value
+
+        # noinspection PyUnusedLocal
+        def evaluate(data_list, context):
+            return value
+        return evaluate
 
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.constant(self.value)
 
-class AST_Lookup(AST):
+
+class AST_Lookup(_InternedLeaf):
     """ Abstract syntax tree object (leaf) for lookups in data_list (e.g. attr.strength)
         The name of the entry to look up is stored in self.name
     """
+    __slots__ = ['name']
     typedesc = 'Lookup'
-    needs_env = _EMPTYSET  # every object has this as well.
 
     def __init__(self, name: str, /):
-        super().__init__(needs_env=self.__class__.needs_env)
+        super().__init__(needs_env=_EMPTYSET)
         self.name = name
 
+    @staticmethod
+    def _intern_key(name, /):
+        return name
+
+    def __getnewargs_ex__(self):
+        return (self.name,), {}
+
     def __str__(self, /):
         return self.typedesc + '(' + str(self.name) + ')'
 
-    def eval_ast(self, data_list, context):
-        return data_list.get(self.name)
+    def _compile(self):
+        name = self.name
+
+        # noinspection PyUnusedLocal
+        def evaluate(data_list, context):
+            return data_list.get(name)
+        return evaluate
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('data_list.get(' + gen.constant(self.name) + ')')
 
 
 class AST_IndirectLookup(AST):
     """ Abstract syntax tree object (node) for indirect lookup GET(str), where str is an AST itself
         This is different from AST_Lookup due to error handling and where in the processing parsing occurs.
     """
+    __slots__ = []
     typedesc = 'Indirect Lookup'
-    needs_env = _EMPTYSET
 
     def __init__(self, arg: AST, /):
         assert isinstance(arg, AST)
-        super().__init__(needs_env=self.__class__.needs_env)
-        self.indirect_arg = arg
+        super().__init__(arg)  # The argument is our only child. Free variables in arg are free in self as well.
+
+    def _compile(self):
+        arg_evaluator = self.child[0].evaluator
 
-    def eval_ast(self, data_list, context):
-        name = self.indirect_arg.eval_ast(data_list, context)
-        if not isinstance(name, str):
-            raise CGEvalException('Argument to GET does not evaluate to a string')
-        if not re_key_any.fullmatch(name):
-            raise CGEvalException('Argument ' + name + ' to GET is not a valid key')
-        return data_list.get(name)
+        def evaluate(data_list, context):
+            name = arg_evaluator(data_list, context)
+            if not isinstance(name, str):
+                raise CGEvalException('Argument to GET does not evaluate to a string')
+            if not re_key_any.fullmatch(name):
+                raise CGEvalException('Argument ' + name + ' to GET is not a valid key')
+            return data_list.get(name)
+        return evaluate
 
 
-class AST_Funcname(AST):
+class AST_Funcname(_InternedLeaf):
     """ Abstract syntax tree object (leaf) for lookup of function name (e.g. LIST)
         The name of the looked up function is stored in self.funcname.
 
         Note that for the user, keywords and function names are mostly indistinguishable except that the user may
         overwrite *some* functions.
     """
+    __slots__ = ['function_name']
     typedesc = 'Function Name'
-    needs_env = _EMPTYSET  # set in every object
 
     def __init__(self, function_name: str, /):
-        super().__init__(needs_env=self.__class__.needs_env)
+        super().__init__(needs_env=_EMPTYSET)
         self.function_name = function_name
 
+    @staticmethod
+    def _intern_key(function_name, /):
+        return function_name
+
+    def __getnewargs_ex__(self):
+        return (self.function_name,), {}
+
     def __str__(self, /):
         return self.typedesc + '(' + str(self.function_name) + ')'
 
-    def eval_ast(self, data_list, context):
-        return data_list.get(self.function_name, locator=data_list.find_function(self.function_name.lower()))
+    def _compile(self):
+        function_name = self.function_name
+        lowercase_name = function_name.lower()
+
+        # noinspection PyUnusedLocal
+        def evaluate(data_list, context):
+            return data_list.get(function_name, locator=data_list.find_function(lowercase_name))
+        return evaluate
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('data_list.get(%s, locator=data_list.find_function(%s))'
+                          % (gen.constant(self.function_name), gen.constant(self.function_name.lower())))
 
 
 # We might actually parse core_constants as Literals (of type e.g. function) rather than doing this at
 # the evaluation stage. Note, however, that this would make serializing ASTs more difficult.
-class AST_CoreConstant(AST):
+class AST_CoreConstant(_InternedLeaf):
+    __slots__ = ['name']
     typedesc = 'Core Constant'
-    needs_env = _EMPTYSET
+    may_return_error = False
 
     def __init__(self, name: str, /):
-        super().__init__(needs_env=self.__class__.needs_env)
+        super().__init__(needs_env=_EMPTYSET)
         self.name = name
 
+    @staticmethod
+    def _intern_key(name, /):
+        return name
+
+    def __getnewargs_ex__(self):
+        return (self.name,), {}
+
     def __str__(self, /):
         return self.typedesc + '(' + str(self.name) + ')'
 
-    def eval_ast(self, data_list, context):
-        return core_constants[self.name]
+    def _compile(self):
+        value = core_constants[self.name]
+
+        # noinspection PyUnusedLocal
+        def evaluate(data_list, context):
+            return value
+        return evaluate
 
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.constant(core_constants[self.name])
 
-class AST_Argname(AST):
+
+class AST_Argname(_InternedLeaf):
     """ Abstract syntax tree object (leaf) for variables (e.g. $a appearing in a function FUN[$a]($a*$a) or $Name.
         The name of the variable in stored in self.argname. We do not need to distinguish externally provided
         variables $Name, $Query and internally used ones such as $a.
+        self.slot is the key under which the variable is found in context. This is the name itself, unless the variable
+        appears inside a lambda, in which case it is an index into the lambda's frame.
     """
+    __slots__ = ['argname', 'slot']
     typedesc = 'Argument'
 
-    def __init__(self, argname: str, /, needs_env=_EMPTYSET):
+    def __init__(self, argname: str, /, needs_env=_EMPTYSET, slot=None):
         self.argname = argname
+        self.slot = argname if slot is None else slot
         super().__init__(needs_env=needs_env)
 
+    @staticmethod
+    def _intern_key(argname, /, needs_env=_EMPTYSET, slot=None):
+        return argname, frozenset(needs_env), slot
+
+    def __getnewargs_ex__(self):
+        return (self.argname,), {'needs_env': self.needs_env, 'slot': self.slot}
+
     def __str__(self, /):
         return self.typedesc + '(' + str(self.argname) + ')'
 
-    def eval_ast(self, data_list, context: dict):
-        # Because we track free variables when constructing ASTs, missing variables should be caught when
-        # constructing ASTs rather than at evaluation time.
-        # So KeyError exceptions here should not occur from bad input, but indicate bugs.
-        return context[self.argname]
+    def _rebind(self, scope: dict, /) -> AST_Argname:
+        return AST_Argname(self.argname, needs_env=self.needs_env, slot=scope[self.argname])
+
+    def _compile(self):
+        slot = self.slot
+
+        # noinspection PyUnusedLocal
+        def evaluate(data_list, context):
+            # Because we track free variables when constructing ASTs, missing variables should be caught when
+            # constructing ASTs rather than at evaluation time.
+            # So KeyError / IndexError exceptions here should not occur from bad input, but indicate bugs.
+            return context[slot]
+        return evaluate
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('context[' + gen.constant(self.slot) + ']')
 
 
 class AST_Auto(AST):
@@ -639,44 +1159,88 @@ class AST_Auto(AST):
         this). The new query name is either the original $Query or $Name, depending on whether we use $AUTOQUERY or
         $AUTO. This is stored in self.queryname
     """
+    __slots__ = ['queryname', 'query_slot', 'continue_slot']
     typedesc = 'Auto'
 
     def __init__(self, /, queryname: str):
-        super().__init__(needs_env={CONTINUE_LOOKUP, queryname})
+        super().__init__(needs_env=_interned_env(_AUTO_ENVS[queryname]))
         self.queryname = queryname
+        # keys into context where to find the query name and the remaining lookup candidates. See AST_Argname.slot
+        self.query_slot = queryname
+        self.continue_slot = CONTINUE_LOOKUP
+
+    def _rebind(self, scope: dict, /) -> AST_Auto:
+        ret = copy.copy(self)
+        ret.query_slot = scope[self.queryname]
+        ret.continue_slot = scope[CONTINUE_LOOKUP]
+        return ret
 
-    def eval_ast(self, data_list, context: dict):
-        return data_list.get(context[self.queryname], locator=context[CONTINUE_LOOKUP])
+    def _compile(self):
+        query_slot = self.query_slot
+        continue_slot = self.continue_slot
+
+        def evaluate(data_list, context):
+            return data_list.get(context[query_slot], locator=context[continue_slot])
+        return evaluate
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('data_list.get(context[%s], locator=context[%s])'
+                          % (gen.constant(self.query_slot), gen.constant(self.continue_slot)))
 
 
 class AST_FunctionCall(AST):
     """ Abstract syntax tree (inner node) for function calls. First child is function object (more precisely, an AST
-        that evaluates to one). The remaining children are the arguments ASTs. The children ASTs have special flags set
-        to determine the *-ed-ness and binding type.
+        that evaluates to one). The remaining children are the arguments ASTs. self.argkinds holds an
+        (argtype, namebind) - pair for each argument to determine the *-ed-ness and binding type.
     """
+    __slots__ = ['argkinds', 'positional_only']
     typedesc = 'Call'
 
-    def eval_ast(self, data_list, context: dict):
-        fun = self.child[0].eval_ast(data_list, context)
-        if isinstance(fun, DataError):
-            return fun
-        # build list and dict of keyword and positional arguments
-        posargs = []
-        kwargs = {}
-        for arg in self.child[1:]:
-            a = arg.eval_ast(data_list, context)
-            if isinstance(a, DataError):
-                return a
-            if arg.argtype is _FUNARG_EXP:  # normal positional argument f(1)
-                posargs.append(a)
-            elif arg.argtype is _FUNARG_STAREXP:  # list-unpacked *-argument f(*posargs)
-                posargs += a
-            elif arg.argtype is _FUNARG_STARSTAREXP:  # dict-unpacked kw-argument f(**kwargs)
-                kwargs.update(**a)
+    def __init__(self, fun: AST, args: list, /):
+        """
+        :param fun: AST for the function object
+        :param args: list of triples (AST, argtype, namebind) for the arguments. namebind is None unless argtype is
+                     _FUNARG_NAMEVAL.
+        """
+        super().__init__(fun, *[arg[0] for arg in args])
+        self.argkinds = tuple([(arg[1], arg[2]) for arg in args])
+        # Most calls only have plain positional arguments f(a, b). For these, generated code calls fun directly.
+        self.positional_only = all([arg[1] is _FUNARG_EXP for arg in args])
+
+    def __str__(self, /):
+        argstrings = [str(self.child[0])]
+        for arg, (argtype, namebind) in zip(self.child[1:], self.argkinds):
+            if argtype is _FUNARG_STAREXP:
+                argstrings.append('*' + str(arg))
+            elif argtype is _FUNARG_STARSTAREXP:
+                argstrings.append('**' + str(arg))
+            elif argtype is _FUNARG_NAMEVAL:
+                argstrings.append(str(arg) + ' bound to ' + namebind)
+            else:
+                argstrings.append(str(arg))
+        return self.typedesc + '[' + ", ".join(argstrings) + ']'
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        fun = gen.checked_value(self.child[0])
+        if self.positional_only:
+            args = [gen.checked_value(arg) for arg in self.child[1:]]
+            return gen.assign(fun + '(' + ', '.join(args) + ')')
+        # Otherwise, we build a list and a dict of positional and keyword arguments. Since the kind of each argument
+        # is known here, the generated code does not need to check for it.
+        posargs = gen.assign('[]')
+        kwargs = gen.assign('{}')
+        for arg, (argtype, namebind) in zip(self.child[1:], self.argkinds):
+            a = gen.checked_value(arg)
+            if argtype is _FUNARG_EXP:  # normal positional argument f(1)
+                gen.emit(posargs + '.append(' + a + ')')
+            elif argtype is _FUNARG_STAREXP:  # list-unpacked *-argument f(*posargs)
+                gen.emit(posargs + ' += ' + a)
+            elif argtype is _FUNARG_STARSTAREXP:  # dict-unpacked kw-argument f(**kwargs)
+                gen.emit(kwargs + '.update(**' + a + ')')
             else:
-                assert arg.argtype is _FUNARG_NAMEVAL  # keyword-argument f(blah = "foo")
-                kwargs[arg.namebind] = a
-        return fun(*posargs, **kwargs)
+                assert argtype is _FUNARG_NAMEVAL  # keyword-argument f(blah = "foo")
+                gen.emit(kwargs + '[' + gen.constant(namebind) + '] = ' + a)
+        return gen.assign(fun + '(*' + posargs + ', **' + kwargs + ')')
 
 
 # Lambdas
@@ -684,14 +1248,20 @@ class AST_Lambda(AST):
     """ Abstract syntax tree (inner node) for function definitions. These always have 2 children. The first child
         encodes the list of expected variables, the second is the function body. Note that the function body is an AST,
         whereas the list of expected variables is not.
+
+        When the lambda is called, the body is evaluated with a frame rather than a dict as context. The frame holds
+        the values of the free variables of the lambda (captured at definition time, in the order of self.captures),
+        followed by one entry per named expected argument (in order of self.arg_slots).
     """
 
+    __slots__ = ['capture_names', 'captures', 'arg_slots', 'frame_size', 'positional_arity', 'default_is_precomputable']
     typedesc = 'Lambda'
 
     def __init__(self, expected_args: list, body: AST):
         """
         construct a new lambda
-        :param expected_args: list of tuples (name, type [,default-value]) for the arguments.
+        :param expected_args: list of triples (name, type, default-value) for the arguments. default-value is None for
+                              arguments without a default.
                               type encodes the *-ed-ness and whether a default is present
         :param body: function body as AST
         """
@@ -702,8 +1272,8 @@ class AST_Lambda(AST):
         # By going backwards and removing before adding, we ensure means that
         # lambdas such as FUN[$c,$d]( FUN[$a, $b=$a, $c=$c]($a+$b+$c+$d) ) work out correctly:
         # $b = $a will default $b to the first positional argument
-        # (In eval_ast, we assign the new local context from left to right and evaluate defaults with the new
-        # local context)
+        # (In eval_ast, we assign the new local frame from left to right and evaluate defaults with the new
+        # local frame)
         # $c = $c will default the inner $c to the outer $c
         # Note that special args like $Name, $Query in the body or as default args refer to the definition context.
         needs_env = set(body.needs_env)
@@ -712,142 +1282,255 @@ class AST_Lambda(AST):
             if arg[1] is _ARGTYPE_DEFAULT:
                 needs_env |= arg[2].needs_env
 
-        super().__init__(expected_args, body, needs_env=needs_env)
+        # Lay out the frame: free variables first, then the named arguments in order.
+        # scope maps variable names to frame indices. We resolve each default argument with the scope at its position,
+        # i.e. before later arguments shadow free variables of the same name. This matches the semantics described
+        # above. The body sees all arguments.
+        self.capture_names = tuple(sorted(needs_env))
+        # keys into the defining context for the captured values. See AST_Argname.slot
+        self.captures = self.capture_names
+        scope = {name: index for index, name in enumerate(self.capture_names)}
+        frame_size = len(self.capture_names)
+        resolved_args = []
+        arg_slots = []
+        for arg in expected_args:
+            if arg[1] is _ARGTYPE_DEFAULT:
+                resolved_args.append((arg[0], arg[1], arg[2]._rebind(scope)))
+            else:
+                resolved_args.append(arg)
+            if arg[0] is None:  # a lone * in the argument list does not bind a variable.
+                arg_slots.append(None)
+            else:  # Note that arguments may shadow captured variables of the same name, so len(scope) is no slot count.
+                arg_slots.append(frame_size)
+                scope[arg[0]] = frame_size
+                frame_size += 1
+        self.arg_slots = tuple(arg_slots)
+        self.frame_size = frame_size
+        # If there are only (possibly defaulted) named arguments, a call that gives a value for each of them
+        # positionally just appends the values to the frame. This is the most common case, which we handle separately.
+        if all([arg[1] is _ARGTYPE_NORMAL or arg[1] is _ARGTYPE_DEFAULT for arg in expected_args]):
+            self.positional_arity = len(expected_args)
+        else:
+            self.positional_arity = None
+        # A default value that does not refer to earlier arguments only depends on the captured values. It can be
+        # evaluated once per evaluation of the lambda expression rather than once per call, see _compile.
+        earlier_args = set()
+        default_is_precomputable = []
+        for arg in expected_args:
+            default_is_precomputable.append(arg[1] is _ARGTYPE_DEFAULT and arg[2].needs_env.isdisjoint(earlier_args))
+            earlier_args.add(arg[0])
+        self.default_is_precomputable = tuple(default_is_precomputable)
+
+        super().__init__(tuple(resolved_args), body._rebind(scope), needs_env=_interned_env(frozenset(needs_env)))
+
+    def _rebind(self, scope: dict, /) -> AST_Lambda:
+        # Only the captured values are looked up in the enclosing context. The body and default arguments are already
+        # resolved relative to our own frame.
+        ret = copy.copy(self)
+        ret.captures = tuple([scope[name] for name in self.capture_names])
+        return ret
 
-    def eval_ast(self, data_list, context: dict):
-        # self.child[0] is a list of pairs (name, type) or triples (name, type, defaultarg) for the variable names:
+    def _compile(self):
+        # self.child[0] is a tuple of triples (name, type, defaultarg) for the variable names:
         # name is a string denoting the actual name (or None for *)
         # type is a string constant set to _ARGTYPE_FOO to differentiate
         # name, name = default, *, *name and **name
+        # defaultarg is None unless type is _ARGTYPE_DEFAULT.
         # self.child[1] is an AST for the actual function body.
         # As opposed to Python proper, it does not matter much when we evaluate default arguments,
         # because we can't mutate anyway.
-        # We choose to evaluate at (each) call, if actually needed.
+        # We choose to evaluate at (each) call, if actually needed. (Defaults that do not depend on previous arguments
+        # are only evaluated on the first call that needs them. This makes no difference, since we can't mutate.)
         # This means that unused invalid default arguments do not trigger errors and that we can use previous argument
         # values as defaults: LAMBDA[$a, $b=$a](...)
         # Special args like $Name in default arguments or the body bind to the value at lambda definition,
-        # because we capture old_context.
+        # because we capture them from context now.
 
-        # We return a function that captures the local variables expectedargs, body and old_context.
-        # (i.e. the returned function object contains references to data_list, body, and to a copy of context)
+        # We return a function that captures the local variables expectedargs, body and captured.
+        # (i.e. the returned function object contains references to data_list, body, and to the captured values)
         # We assume that during the lifetime of the returned function, the passed arguments data_list does not change.
-        expectedargs = self.child[0]
-        # expectedargs is a list of tuples ($name, $type [, default-value] ) of the arguments that the function expects
-        body = self.child[1]
-
-        # We (shallow) copy the given context at time of lambda definition. This is needed, because the
-        # caller might mutate context later. This is a bit inconsistent with data_list, but we can't really copy that
-        # due to efficiency. We need to assume there that the passed data_list and the entries of context are not
-        # mutated during the lifetime of the resulting lambda.
-
-        old_context = dict(context)
-
-        def fun(*funargs, **kwargs):
-            new_context = dict(old_context)  # shallow copy should be OK. We do not modify new_context[key] values
-            # As opposed to above, this copy is done for each lambda evaluation.
-            funargpos = 0  # index of next funarg that has not yet been assigned to an expected argument
-            funarglen = len(funargs)  # number of positional arguments that we actually got
-            kwargonly = False  # set to true after we encounter a * (in the arguments in the lambda def)
-            for arg in expectedargs:  # expectedargs ist the list of arguments in the lambda's definition. All of
-                # these need to be assigned in new_context.
-                if arg[1] is _ARGTYPE_NORMAL or arg[1] is _ARGTYPE_DEFAULT:  # non-starred argument in lambda def
-                    if arg[0] in kwargs:  # argument is given as a keyword-argument
-                        # Note that modifying kwargs does not mutate anything at the call site:
-                        # def fun(**D):
-                        #     del D['foo']
-                        # D = {'foo':'bar'}
-                        # fun(**D) will not modify D.
-                        new_context[arg[0]] = kwargs.pop(arg[0])
+        # expectedargs is a tuple of tuples ($name, $type, default_evaluator, cache_index, slot), one for each argument
+        # that the function expects. default_evaluator is None if there is no default value. cache_index is the
+        # position of the default value in cached_defaults below if the default value can be precomputed, None
+        # otherwise. slot is the position of the argument in the frame.
+        # (We unpack these tuples into local variables when calling, which is faster than repeatedly indexing arg)
+        expectedargs = []
+        cached_count = 0
+        for arg, precomputable, slot in zip(self.child[0], self.default_is_precomputable, self.arg_slots):
+            if precomputable:
+                expectedargs.append((arg[0], arg[1], arg[2].evaluator, cached_count, slot))
+                cached_count += 1
+            elif arg[1] is _ARGTYPE_DEFAULT:
+                expectedargs.append((arg[0], arg[1], arg[2].evaluator, None, slot))
+            else:
+                expectedargs.append((arg[0], arg[1], None, None, slot))
+        expectedargs = tuple(expectedargs)
+        # Calls without keyword arguments that omit some trailing defaulted arguments are handled by a faster code
+        # path as well: missing_defaults maps the number of given positional arguments to the pairs
+        # (default_evaluator, cache_index) for the remaining arguments, which we just append to the frame.
+        missing_defaults = {}
+        if self.positional_arity is not None:
+            for given in range(self.positional_arity - 1, -1, -1):
+                if expectedargs[given][1] is not _ARGTYPE_DEFAULT:
+                    break
+                missing_defaults[given] = tuple([(arg[2], arg[3]) for arg in expectedargs[given:]])
+        body_evaluator = self.child[1].evaluator
+        unbound_frame = [None] * (self.frame_size - len(self.captures))
+        captures = self.captures
+        positional_arity = self.positional_arity
+
+        def evaluate(data_list, context):
+            # We copy the values of the free variables at time of lambda definition. This is needed, because the
+            # caller might mutate context later. This is a bit inconsistent with data_list, but we can't really copy
+            # that due to efficiency. We need to assume there that the passed data_list and the entries of context are
+            # not mutated during the lifetime of the resulting lambda.
+
+            captured = [context[key] for key in captures]
+            # Precomputable default values are evaluated upon first use and then remembered for the lifetime of fun.
+            # We do not evaluate them right away, so unused invalid default arguments still do not trigger errors.
+            cached_defaults = [_NOT_COMPUTED] * cached_count
+
+            def fun(*funargs, **kwargs):
+                if not kwargs:
+                    if len(funargs) == positional_arity:  # see __init__
+                        return body_evaluator(data_list, captured + list(funargs))
+                    defaults = missing_defaults.get(len(funargs))
+                    if defaults is not None:
+                        frame = captured + list(funargs)
+                        for default_evaluator, cache_index in defaults:
+                            if cache_index is None:
+                                defaultarg = default_evaluator(data_list, frame)  # frame holds the arguments so far.
+                            else:
+                                defaultarg = cached_defaults[cache_index]
+                                if defaultarg is _NOT_COMPUTED:
+                                    defaultarg = cached_defaults[cache_index] = default_evaluator(data_list, frame)
+                            if type(defaultarg) is DataError:
+                                return defaultarg
+                            frame.append(defaultarg)
+                        return body_evaluator(data_list, frame)
+                frame = captured + unbound_frame  # new list; we do not modify the values of captured.
+                # As opposed to above, this copy is done for each lambda evaluation.
+                funargpos = 0  # index of next funarg that has not yet been assigned to an expected argument
+                funarglen = len(funargs)  # number of positional arguments that we actually got
+                kwargonly = False  # set to true after we encounter a * (in the arguments in the lambda def)
+                # expectedargs describes the list of arguments in the lambda's definition. All of these need to be
+                # assigned in frame.
+                for argname, argtype, default_evaluator, cache_index, slot in expectedargs:
+                    if argtype is _ARGTYPE_NORMAL or argtype is _ARGTYPE_DEFAULT:  # non-starred argument in lambda def
+                        if kwargs and argname in kwargs:  # argument is given as a keyword-argument
+                            # Note that modifying kwargs does not mutate anything at the call site:
+                            # def fun(**D):
+                            #     del D['foo']
+                            # D = {'foo':'bar'}
+                            # fun(**D) will not modify D.
+                            frame[slot] = kwargs.pop(argname)
+                            if funargpos != funarglen:
+                                raise AttributeError(
+                                    "keyword argument used before (expected or given) positional argument")
+                        elif funargpos < funarglen:  # Still have positional arguments given to fun left. Take the next.
+                            frame[slot] = funargs[funargpos]
+                            funargpos += 1
+                        elif argtype is _ARGTYPE_NORMAL:
+                            if kwargonly:
+                                raise AttributeError("Missing Keyword-only argument $" + argname)
+                            else:
+                                raise AttributeError("Missing positional argument $" + argname)
+                        else:  # argtype is _ARGTYPE_DEFAULT, not given as keyword, no more positional arguments given.
+                            if cache_index is None:
+                                defaultarg = default_evaluator(data_list, frame)  # frame holds the arguments so far.
+                            else:
+                                defaultarg = cached_defaults[cache_index]
+                                if defaultarg is _NOT_COMPUTED:
+                                    defaultarg = cached_defaults[cache_index] = default_evaluator(data_list, frame)
+                            if type(defaultarg) is DataError:
+                                return defaultarg
+                            frame[slot] = defaultarg
+                    elif argtype is _ARGTYPE_STAR:
+                        kwargonly = True
                         if funargpos != funarglen:
-                            raise AttributeError("keyword argument used before (expected or given) positional argument")
-                    elif funargpos < funarglen:  # Still have positional arguments given to fun left. We take the next.
-                        new_context[arg[0]] = funargs[funargpos]
-                        funargpos += 1
-                    elif arg[1] is _ARGTYPE_NORMAL:
-                        if kwargonly:
-                            raise AttributeError("Missing Keyword-only argument $" + arg[0])
-                        else:
-                            raise AttributeError("Missing positional argument $" + arg[0])
-                    else:  # arg[1] is _ARGTYPE_DEFAULT, not given as keyword, no more positional arguments given.
-                        defaultarg = arg[2].eval_ast(data_list, new_context)  # We need to use new_context here
-                        if isinstance(defaultarg, DataError):
-                            return defaultarg
-                        new_context[arg[0]] = defaultarg
-                elif arg[1] is _ARGTYPE_STAR:
-                    kwargonly = True
-                    if funargpos != funarglen:
-                        raise AttributeError("too many positional arguements")
-                elif arg[1] is _ARGTYPE_STARARG:  # *$arg is guaranteed to be the last arg in expectedargs
-                    new_context[arg[0]] = funargs[funargpos:]  # assign $arg to the remaining positional args given
-                    funargpos = funarglen
-                    kwargonly = True
-                else:
-                    assert arg[1] is _ARGTYPE_KWARGS
-                    new_context[arg[0]] = kwargs  # kwargs that matched required positionals have been popped before.
-                    kwargs = {}
-            if len(kwargs) > 0:
-                raise AttributeError("Unknown keyword argument $" + next(iter(kwargs.keys())))
-            if funargpos != funarglen:
-                raise AttributeError("Too many positional arguments")
-            return body.eval_ast(data_list, new_context)
+                            raise AttributeError("too many positional arguements")
+                    elif argtype is _ARGTYPE_STARARG:  # *$arg is guaranteed to be the last arg in expectedargs
+                        frame[slot] = funargs[funargpos:]  # assign $arg to the remaining positional args given
+                        funargpos = funarglen
+                        kwargonly = True
+                    else:
+                        assert argtype is _ARGTYPE_KWARGS
+                        frame[slot] = kwargs  # kwargs that matched required positionals have been popped before.
+                        kwargs = {}
+                if kwargs:
+                    raise AttributeError("Unknown keyword argument $" + next(iter(kwargs.keys())))
+                if funargpos != funarglen:
+                    raise AttributeError("Too many positional arguments")
+                return body_evaluator(data_list, frame)
 
-        return fun
+            return fun
+        return evaluate
 
 
 class AST_List(AST):
+    __slots__ = []
     typedesc = 'List'
+    may_return_error = False
     # default init does The Right Thing (TM): self.child is a tuple of child AST objects.
 
-    def eval_ast(self, data_list: BaseCharVersion, context: dict):
-        ret = []
-        for c in self.child:
-            c_eval = c.eval_ast(data_list, context)
-            if isinstance(c_eval, DataError):
-                return c_eval
-            ret.append(c_eval)
-        return ret
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('[' + ', '.join([gen.checked_value(c) for c in self.child]) + ']')
 
 
 class AST_Dict(AST):
+    __slots__ = []
     typedesc = 'Dict'
+    may_return_error = False
     # default init does The Right Thing (TM)
 
-    def eval_ast(self, data_list: BaseCharVersion, context: dict):
+    def _generate(self, gen: _CodeGenerator, /) -> str:
         assert len(self.child) % 2 == 0
-        ret = {}
-        it = iter(self.child)
-        while True:
-            try:
-                c_kw = next(it)
-            except StopIteration:
-                break
-            c_kw = c_kw.eval_ast(data_list, context)
-            if isinstance(c_kw, DataError):
-                return c_kw
-            c_val = next(it).eval_ast(data_list, context)
-            if isinstance(c_val, DataError):
-                return c_val
-            ret[c_kw] = c_val
+        ret = gen.assign('{}')
+        # Entries are inserted one at a time, so an unhashable key raises before later entries are evaluated.
+        for key, value in zip(self.child[0::2], self.child[1::2]):
+            key = gen.checked_value(key)
+            value = gen.checked_value(value)
+            gen.emit(ret + '[' + key + '] = ' + value)
         return ret
 
 
 class AST_Set(AST):
+    __slots__ = []
     typedesc = 'Set'
-
-    def eval_ast(self, data_list: BaseCharVersion, context: dict):
-        ret = []
-        for c in self.child:
-            c_eval = c.eval_ast(data_list, context)
-            if isinstance(c_eval, DataError):
-                return c_eval
-            ret.append(c_eval)
-        return frozenset(ret)
-
-
-start = 'root_expression'  # start is used by PLY yacc to determine the BNF roof.
-
-# order of precedence and associativity of operations. Ambiguous cases will produce errors.
-precedence = (
+    may_return_error = False
+
+    def _generate(self, gen: _CodeGenerator, /) -> str:
+        return gen.assign('frozenset([' + ', '.join([gen.checked_value(c) for c in self.child]) + '])')
+
+
+# The parser itself is a hand-written recursive descent parser, where expressions with operators are parsed by
+# precedence climbing (also known as a Pratt parser). The grammar is small enough that this is easy to maintain and it
+# is much faster than a table-driven parser generator.
+# In EBNF, the grammar is as follows (terminals are token types from the tokenizer above or literals in quotes):
+#
+# root_expression   : expression
+# expression        : expression binop expression       (see precedence below)
+#                   | NOT expression
+#                   | expression '(' [argument {',' argument} [',']] ')'        (function call)
+#                   | expression '[' expression ']'                             (indexing)
+#                   | '(' expression ')'
+#                   | STRING | FLOAT | INT | CORECONSTANT | FUNCNAME | LOOKUP | ARGNAME | SPECIALARG | AUTO
+#                   | COND '(' expression ',' expression ',' expression ')'
+#                   | IF expression THEN expression ELSE expression
+#                   | GET '(' expression ')'
+#                   | '[' [expression {',' expression} [',']] ']'                                   (list)
+#                   | '{' [expression ':' expression {',' expression ':' expression} [',']] '}'     (dict)
+#                   | '{' expression {',' expression} [','] '}'                                     (set)
+#                   | FUN '[' [declarg {',' declarg}] ']' '(' expression ')'                        (lambda)
+# argument          : expression | '*' expression | '*' '*' expression | ARGNAME '=' expression | STRING '=' expression
+# declarg           : ARGNAME | ARGNAME '=' expression | '*' | '*' ARGNAME | '*' '*' ARGNAME
+#
+# Function calls and indexing bind tightest. The ELSE-branch of IF ... THEN ... ELSE ... extends as far as possible,
+# i.e. IF a THEN b ELSE c + d means IF a THEN b ELSE (c + d).
+
+# order of precedence (from lowest to highest) and associativity of operations.
+# Comparisons are non-associative, so 1 < 2 < 3 is an error.
+precedence: Final = (
     ('right', 'OR'),
     ('right', 'AND'),
     ('right', 'NOT'),
@@ -856,191 +1539,38 @@ precedence = (
     ('left', '*', '/', '%', 'IDIV'),
 )
 
+# AST classes of binary operators by token type.
+_binary_operators: Final = {
+    'OR': AST_Or,
+    'AND': AST_And,
+    'LTE': AST_LTE,
+    'GTE': AST_GTE,
+    '<': AST_LT,
+    '>': AST_GT,
+    'EQUALS': AST_Equals,
+    'NEQUALS': AST_NEquals,
+    '+': AST_Sum,
+    '-': AST_Sub,
+    '*': AST_Mult,
+    '/': AST_Div,
+    '%': AST_Mod,
+    'IDIV': AST_IDiv,
+}
 
-# noinspection PyUnusedLocal
-def p_error(p, /):
-    raise CGParseException
-
-
-# root_expression serves as a hook for "done with parsing". This does not actually create an extra tree node.
-# noinspection PySingleQuotedDocstring
-def p_root(p, /):
-    "root_expression : expression"
-    p[0] = p[1]
-    if not p[0].needs_env <= _ALLOWED_SPECIAL_ARGS:  # <= means subset here.
-        raise CGParseException("Unbound variables $" + ", $".join(_ALLOWED_SPECIAL_ARGS - p[0].needs_env))
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_bracket(p, /):
-    "expression : '(' expression ')' "
-    p[0] = p[2]
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_literal(p, /):
-    """expression : STRING
-                  | FLOAT
-                  | INT"""
-    p[0] = AST_Literal(p[1])
-
-
-# noinspection PySingleQuotedDocstring
-def p_coreconstant(p, /):
-    "expression : CORECONSTANT"
-    p[0] = AST_CoreConstant(p[1])
-
-# noinspection PySingleQuotedDocstring
-# def p_expression_true(p):
-#     "expression : TRUE"
-#     p[0] = AST_Literal(True)
-
-
-# noinspection PySingleQuotedDocstring
-# def p_expression_false(p):
-#     "expression : FALSE"
-#     p[0] = AST_Literal(False)
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_sum(p, /):
-    "expression : expression '+' expression"
-    p[0] = AST_Sum(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_sub(p, /):
-    "expression : expression '-' expression"
-    p[0] = AST_Sub(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_mult(p, /):
-    "expression : expression '*' expression"
-    p[0] = AST_Mult(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_div(p, /):
-    "expression : expression '/' expression"
-    p[0] = AST_Div(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_idiv(p, /):
-    "expression : expression IDIV expression"
-    p[0] = AST_IDiv(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_modulo(p, /):
-    "expression : expression '%' expression"
-    p[0] = AST_Mod(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_equals(p, /):
-    "expression : expression EQUALS expression"
-    p[0] = AST_Equals(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_nequals(p, /):
-    "expression : expression NEQUALS expression"
-    p[0] = AST_NEquals(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_gt(p, /):
-    "expression : expression '>' expression"
-    p[0] = AST_GT(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_gte(p, /):
-    "expression : expression GTE expression"
-    p[0] = AST_GTE(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_lt(p, /):
-    "expression : expression '<' expression"
-    p[0] = AST_LT(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_lte(p, /):
-    "expression : expression LTE expression"
-    p[0] = AST_LTE(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_and(p, /):
-    "expression : expression AND expression"
-    p[0] = AST_And(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_or(p, /):
-    "expression : expression OR expression"
-    p[0] = AST_Or(p[1], p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_not(p, /):
-    "expression : NOT expression"
-    p[0] = AST_Not(p[2])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_cond(p, /):
-    "expression : COND '(' expression ',' expression ',' expression ')'"
-    p[0] = AST_Cond(p[3], p[5], p[7])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_cond_if_then_else(p, /):
-    "expression : IF expression THEN expression ELSE expression"
-    p[0] = AST_Cond(p[2], p[4], p[6])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_funname(p, /):
-    "expression : FUNCNAME"
-    p[0] = AST_Funcname(p[1])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_name(p, /):
-    "expression : LOOKUP"
-    p[0] = AST_Lookup(p[1])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_get(p, /):
-    "expression : GET '(' expression ')'"
-    p[0] = AST_IndirectLookup(p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_variable(p, /):
-    "expression : ARGNAME"
-    p[0] = AST_Argname(p[1], needs_env=frozenset({p[1]}))
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_specialarg(p, /):
-    "expression : SPECIALARG"
-    p[0] = AST_Argname(p[1], needs_env=frozenset({p[1]}))
-
-
-# noinspection PySingleQuotedDocstring
-def p_expression_auto(p, /):
-    "expression : AUTO"
-    p[0] = AST_Auto(p[1])
-
+# binding power of operators by token type, determined from precedence. Higher binds tighter.
+_binding_power: Final = {token_type: level for level, (_, *token_types) in enumerate(precedence, start=1)
+                         for token_type in token_types}
+# binding power of binary operators. Other tokens (including NOT) end an expression if they appear after an operand.
+_infix_binding_power: Final = {token_type: _binding_power[token_type] for token_type in _binary_operators}
+# binding power that is used to parse the right operand of a binary operator.
+# For left-associative operators, this prevents the right operand from containing the same operator.
+_right_binding_power: Final = {token_type: level - 1 if assoc == 'right' else level
+                               for level, (assoc, *token_types) in enumerate(precedence, start=1)
+                               for token_type in token_types}
+_nonassoc_binding_powers: Final = frozenset(level for level, (assoc, *_) in enumerate(precedence, start=1)
+                                            if assoc == 'nonassoc')
 
-# p_argument turns an expression exp into a function argument, e.g. for use in f(exp)
+# types of arguments appearing in function calls f(...)
 # To be consistent with Python, function arguments can be of the form
 # exp, *exp, **exp, $name=exp
 # We do not wrap exp (and possibly name) into one of 4 different AST_FOO - types.
@@ -1049,204 +1579,34 @@ def p_expression_auto(p, /):
 # must NOT return the tuple 1, 2, since then for a function g(a,b) with
 # arguments a,b, g(*exp) would bind a to the tuple (1,2) and leave b unbound...
 # In fact, *exp is not a valid Python expression in most contexts.
-# The unpacking and the function call have to be handled simultaneously and we just mark the arguments.
-# the p[0].typedesc = ... assignments are just for debugging and printing.
-# Note that p[0].typedesc on the left-hand side is an instance variable, the right-hand side a class variable!
-# p[0].typedesc += "..." would actually work and create an instance variable because python is weird.
-
-# types of arguments appearing in function calls f(...)
+# The unpacking and the function call have to be handled simultaneously and we just mark the arguments:
+# An argument is a triple (exp, argtype, namebind) with namebind = None unless argtype is _FUNARG_NAMEVAL.
+# AST_FunctionCall stores argtype and namebind separately from exp. We can not set them on exp itself, because exp
+# might be an (interned) leaf shared with other ASTs.
 _FUNARG_EXP: Final = 'expression'  # f(x)
 _FUNARG_STAREXP: Final = '*expression'  # f(*list)
 _FUNARG_STARSTAREXP: Final = '**expression'  # f(**dict)
 _FUNARG_NAMEVAL: Final = 'named argument'  # f(name = x)
 
-
-# noinspection PySingleQuotedDocstring
-def p_argument_exp(p, /):
-    "argument : expression"
-    p[0] = p[1]
-    p[0].argtype = _FUNARG_EXP
-
-
-# noinspection PySingleQuotedDocstring
-def p_argument_listexp(p, /):
-    "argument : '*' expression"
-    p[0] = p[2]
-    p[0].argtype = _FUNARG_STAREXP
-    p[0].typedesc = '*' + p[0].typedesc  # this creates an instance variable
-
-
-# noinspection PySingleQuotedDocstring
-def p_argument_dictexp(p, /):
-    "argument : '*' '*' expression"
-    p[0] = p[3]
-    p[0].argtype = _FUNARG_STARSTAREXP
-    p[0].typedesc = '**' + p[0].typedesc  # this creates an instance variable
-
-
-# noinspection PySingleQuotedDocstring
-def p_argument_nameval(p, /):
-    "argument : ARGNAME '=' expression"
-    p[0] = p[3]
-    p[0].argtype = _FUNARG_NAMEVAL
-    p[0].namebind = p[1]
-    p[0].typedesc = p[0].typedesc + ' bound to ' + p[0].namebind  # += actually would work (which I find strange)
-
-
-# noinspection PySingleQuotedDocstring
-def p_argument_nameval_as_string(p, /):
-    "argument : STRING '=' expression"
-    p[0] = p[3]
-    p[0].argtype = _FUNARG_NAMEVAL
-    p[0].namebind = p[1]
-    p[0].typedesc = p[0].typedesc + ' bound to ' + p[0].namebind
-
-
-def p_arglist(p, /):
-    """arglist :
-               | arglist_nonempty
-               | arglist_nonempty ','"""
-    if len(p) == 1:
-        p[0] = []
-    else:
-        p[0] = p[1]
-
-
-def p_arglist_nonempty(p, /):
-    """arglist_nonempty : argument
-                        | arglist_nonempty ',' argument"""
-    if len(p) == 2:
-        p[0] = [p[1]]
-    else:
-        p[0] = p[1] + [p[3]]
-
-
-def p_expressionlist_nonempty(p, /):
-    """expressionlist_nonempty : expression
-                               | expressionlist_nonempty ',' expression"""
-    if len(p) == 2:
-        p[0] = [p[1]]
-    else:
-        p[0] = p[1] + [p[3]]
-
-
-def p_list(p, /):
-    """expression : '[' ']'
-                  | '[' expressionlist_nonempty ']'
-                  | '[' expressionlist_nonempty ',' ']'"""
-    if len(p) == 3:
-        p[0] = AST_List()
-    else:
-        p[0] = AST_List(*p[2])
-
-
-def p_dictlist_nonempty(p, /):
-    """dictlist_nonempty : expression ':' expression
-                         | dictlist_nonempty ',' expression ':' expression"""
-    if len(p) == 4:
-        p[0] = [p[1], p[3]]
-    else:
-        p[0] = p[1] + [p[3], p[5]]
-
-
-def p_dict(p, /):
-    """expression : '{' '}'
-                  | '{' dictlist_nonempty '}'
-                  | '{' dictlist_nonempty ',' '}'"""
-    if len(p) == 3:
-        p[0] = AST_Dict()
-    else:
-        p[0] = AST_Dict(*p[2])
-
-
-def p_set(p, /):
-    """expression : '{' expressionlist_nonempty '}'
-                  | '{' expressionlist_nonempty ',' '}'"""
-    p[0] = AST_Set(*p[2])
-
-
-# noinspection PySingleQuotedDocstring
-def p_function_call(p, /):
-    "expression : expression '(' arglist ')'"
-    # keyword arguments must come after positional arguments :
-    kwonly = False
-    for arg in p[3]:
-        if arg.argtype is _FUNARG_STARSTAREXP or arg.argtype is _FUNARG_NAMEVAL:
-            kwonly = True
-        elif kwonly:
-            raise CGParseException("Positional arguments must not follow keyword arguments")
-    p[0] = AST_FunctionCall(p[1], *p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_getitem(p, /):
-    "expression : expression '[' expression ']'"
-    p[0] = AST_GetItem(p[1], p[3])
-
-
+# types of arguments appearing in function definitions FUN[...](...)
+# An argument in a function definition is a triple (name, argtype, default) with name = None for a lone * and
+# default = None unless argtype is _ARGTYPE_DEFAULT.
 _ARGTYPE_NORMAL = 'Arg'  # def f(x)
 _ARGTYPE_DEFAULT = 'Defaulted Argument'  # def f(x=5)
 _ARGTYPE_STAR = 'End of Positional Arguments'  # def f(*)
 _ARGTYPE_STARARG = 'Rest of Positional Arguments'  # def f(*arg)
 _ARGTYPE_KWARGS = 'Rest of Keyword Arguments'  # def (f**kwargs)
+# marker for default values that have not been evaluated yet, see AST_Lambda
+_NOT_COMPUTED: Final = object()
 
 
-# noinspection PySingleQuotedDocstring
-def p_declarg_name(p, /):
-    "declarg : ARGNAME"
-    p[0] = (p[1], _ARGTYPE_NORMAL)
-
-
-# noinspection PySingleQuotedDocstring
-def p_declarg_defaulted_name(p, /):
-    "declarg : ARGNAME '=' expression"
-    p[0] = (p[1], _ARGTYPE_DEFAULT, p[3])
-
-
-# noinspection PySingleQuotedDocstring
-def p_declarg_pos_end(p, /):
-    "declarg : '*'"
-    p[0] = (None, _ARGTYPE_STAR)
-
-
-# noinspection PySingleQuotedDocstring
-def p_declarg_pos_rest(p, /):
-    "declarg : '*' ARGNAME"
-    p[0] = (p[2], _ARGTYPE_STARARG)
-
-
-# noinspection PySingleQuotedDocstring
-def p_declarg_kw_rest(p, /):
-    "declarg : '*' '*' ARGNAME"
-    p[0] = (p[3], _ARGTYPE_KWARGS)
-
-
-def p_declarg_list(p, /):
-    """declarglist :
-                    | declarglist_nonempty"""
-    if len(p) == 1:
-        p[0] = []
-    else:
-        p[0] = p[1]
-    if len(p[0]) != len(set(x[0] for x in p[0])):
+def _check_declarglist(args: list, /) -> None:
+    """
+    Checks validity of the argument list of a function definition and raises CGParseException if invalid:
+    There are restrictions on the order of argument types (kw-arguments after positional arguments etc.)
+    """
+    if len(args) != len(set(x[0] for x in args)):
         raise CGParseException("Duplicate argument used in function definition")
-
-
-def p_declarglist_nonempty(p, /):
-    """declarglist_nonempty : declarg
-                            | declarglist_nonempty ',' declarg"""
-    if len(p) == 2:
-        p[0] = [p[1]]
-    else:
-        p[0] = p[1] + [p[3]]
-
-
-# noinspection PySingleQuotedDocstring
-def p_functiondef(p, /):
-    "expression : FUN '[' declarglist ']' '(' expression ')'"
-    args = p[3]
-    # Check validity of argument list : There are restrictions on the order of argument types
-    # (kw-arguments after positional arguments etc
     seen_default = False
     seen_restkw = False
     seen_end = False
@@ -1266,10 +1626,327 @@ def p_functiondef(p, /):
             seen_end = True
         else:
             assert False
-    p[0] = AST_Lambda(args, p[6])  # Note that p[3] is a list, which is NOT unpacked here. p[6] is the body.
 
 
-parser = yacc.yacc()
+# Maximal nesting depth of subexpressions in formulas, other than brackets ( ) and chains of binary operators.
+# E.g. [[1]], NOT NOT 1 and f(g(1)) have nesting depth 3. Parsing, compiling and evaluating such nested subexpressions
+# recurses, so we limit their depth to stay well below Python's recursion limit.
+_MAX_NESTING_DEPTH: Final = 200
+
+
+class _ExpressionParser:
+    """
+    Parser that turns input strings into ASTs. Use parser.parse(input_string) on the module-level parser object.
+
+    The parser pulls tokens from the tokenizer one at a time. self.token is the current (i.e. next unprocessed) token
+    or None at the end of the input. Every method _parse_foo starts at the first token of foo and stops at the first
+    token after foo.
+    Note that parsing is not reentrant, as the parser keeps its state in the object.
+    """
+
+    def __init__(self):
+        self.tokens = None  # iterator over the remaining tokens
+        self.token = None  # current token
+        self.peeked = None  # token after the current token, if we looked ahead. See self._peek()
+        self.depth = 0  # number of active calls to self._parse_expression
+
+    def parse(self, input_string: str, /) -> AST:
+        """
+        Parses input_string into an AST. Raises CGParseException or SyntaxError (from the tokenizer) on invalid input.
+        """
+        self.tokens = _tokenize(input_string)
+        self.peeked = None
+        self.depth = 0
+        self._advance()
+        ret = self._parse_expression(0)
+        if self.token is not None:
+            self._error()
+        if not ret.needs_env <= _ALLOWED_SPECIAL_ARGS:  # <= means subset here.
+            raise CGParseException("Unbound variables $" + ", $".join(sorted(ret.needs_env - _ALLOWED_SPECIAL_ARGS)))
+        return ret
+
+    def _advance(self) -> _Token:
+        """
+        Moves to the next token and returns the previous one.
+        """
+        ret = self.token
+        if self.peeked is None:
+            self.token = next(self.tokens, None)
+        else:
+            self.token = self.peeked
+            self.peeked = None
+        return ret
+
+    def _peek(self) -> Union[_Token, None]:
+        """
+        Returns the token after the current one (without advancing).
+        """
+        if self.peeked is None:
+            self.peeked = next(self.tokens, None)
+        return self.peeked
+
+    def _error(self):
+        if self.token is None:
+            raise CGParseException("Unexpected end of formula")
+        raise CGParseException("Unexpected " + str(self.token.value))
+
+    def _at(self, token_type: str, /) -> bool:
+        return self.token is not None and self.token.type == token_type
+
+    def _expect(self, token_type: str, /) -> _Token:
+        """
+        Checks that the current token is of type token_type, then advances and returns the token.
+        """
+        if self.token is None or self.token.type != token_type:
+            self._error()
+        return self._advance()
+
+    def _parse_expression(self, right_binding_power: int, /) -> AST:
+        """
+        Parses an expression that extends as long as the operators bind tighter than right_binding_power.
+        """
+        # Brackets and binary operators are handled with an explicit stack rather than by recursion, so deeply nested
+        # brackets or long chains such as a + b + c + ... do not exhaust Python's recursion limit.
+        # Entries of the stack are (left, token_type, binding_power) for a binary operator whose right operand we are
+        # parsing or (None, '(', 0) for an opening bracket. binding_power is the right binding power for the operand.
+        self.depth += 1
+        if self.depth > _MAX_NESTING_DEPTH:
+            raise CGParseException("formula nested too deeply")
+        stack = []
+        while True:
+            while self._at('('):
+                self._advance()
+                stack.append((None, '(', 0))
+            left = self._parse_atom()
+            # binding power of the last operator applied to left (or None if left is an atom). This is used to detect
+            # chained non-associative operators.
+            last_binding_power = None
+            while True:
+                token_type = None if self.token is None else self.token.type
+                if token_type == '(':  # function call
+                    left = self._parse_call(left)
+                    last_binding_power = None
+                    continue
+                elif token_type == '[':  # indexing
+                    self._advance()
+                    index = self._parse_expression(0)
+                    self._expect(']')
+                    left = make_binop(AST_GetItem, left, index)
+                    last_binding_power = None
+                    continue
+                binding_power = _infix_binding_power.get(token_type)
+                if binding_power is not None and binding_power > (stack[-1][2] if stack else right_binding_power):
+                    if binding_power == last_binding_power and binding_power in _nonassoc_binding_powers:
+                        raise CGParseException("Comparisons must not be chained")
+                    self._advance()
+                    stack.append((left, token_type, _right_binding_power[token_type]))
+                    break  # parse the right operand
+                # The current token ends the innermost pending operand.
+                if not stack:
+                    self.depth -= 1
+                    return left
+                operand, token_type, _ = stack.pop()
+                if token_type == '(':
+                    self._expect(')')
+                    last_binding_power = None
+                    continue
+                op = _binary_operators[token_type]
+                if issubclass(op, AST_BinOp):
+                    left = make_binop(op, operand, left)
+                elif op is AST_And:
+                    left = make_and(operand, left)
+                else:
+                    assert op is AST_Or
+                    left = make_or(operand, left)
+                last_binding_power = _binding_power[token_type]
+
+    def _parse_atom(self) -> AST:
+        """
+        Parses an expression that starts with a literal, a name, a keyword, or a bracket other than '('.
+        (This includes the prefix operator NOT, but not postfix function calls and indexing. Parentheses are handled by
+        _parse_expression)
+        """
+        token = self.token
+        if token is None:
+            self._error()
+        token_type = token.type
+        if token_type == 'STRING' or token_type == 'FLOAT' or token_type == 'INT':
+            self._advance()
+            return AST_Literal(token.value)
+        elif token_type == 'LOOKUP':
+            self._advance()
+            return AST_Lookup(token.value)
+        elif token_type == 'ARGNAME' or token_type == 'SPECIALARG':
+            self._advance()
+            return AST_Argname(token.value, needs_env=_variable_env(token.value))
+        elif token_type == 'FUNCNAME':
+            self._advance()
+            return AST_Funcname(token.value)
+        elif token_type == 'CORECONSTANT':
+            self._advance()
+            return AST_CoreConstant(token.value)
+        elif token_type == 'AUTO':
+            self._advance()
+            return AST_Auto(token.value)
+        elif token_type == 'NOT':
+            self._advance()
+            return make_not(self._parse_expression(_binding_power['NOT']))
+        elif token_type == 'IF':
+            self._advance()
+            cond = self._parse_expression(0)
+            self._expect('THEN')
+            true_branch = self._parse_expression(0)
+            self._expect('ELSE')
+            return make_cond(cond, true_branch, self._parse_expression(0))
+        elif token_type == 'COND':
+            self._advance()
+            self._expect('(')
+            cond = self._parse_expression(0)
+            self._expect(',')
+            true_branch = self._parse_expression(0)
+            self._expect(',')
+            false_branch = self._parse_expression(0)
+            self._expect(')')
+            return make_cond(cond, true_branch, false_branch)
+        elif token_type == 'GET':
+            self._advance()
+            self._expect('(')
+            ret = AST_IndirectLookup(self._parse_expression(0))
+            self._expect(')')
+            return ret
+        elif token_type == '[':
+            self._advance()
+            return AST_List(*self._parse_expression_list(']'))
+        elif token_type == '{':
+            return self._parse_dict_or_set()
+        elif token_type == 'FUN':
+            return self._parse_lambda()
+        self._error()
+
+    def _parse_expression_list(self, closing: str, /) -> list:
+        """
+        Parses a possibly empty comma-separated list of expressions (with optional trailing comma) up to and including
+        the closing bracket.
+        """
+        ret = []
+        while not self._at(closing):
+            ret.append(self._parse_expression(0))
+            if not self._at(closing):
+                self._expect(',')
+        self._advance()
+        return ret
+
+    def _parse_dict_or_set(self) -> AST:
+        self._expect('{')
+        if self._at('}'):  # {} is an empty dict, as in Python.
+            self._advance()
+            return AST_Dict()
+        first = self._parse_expression(0)
+        if not self._at(':'):
+            if not self._at('}'):
+                self._expect(',')
+            return AST_Set(first, *self._parse_expression_list('}'))
+        # dict: The children of AST_Dict are alternating keys and values
+        entries = [first]
+        self._advance()
+        entries.append(self._parse_expression(0))
+        while not self._at('}'):
+            self._expect(',')
+            if self._at('}'):
+                break
+            entries.append(self._parse_expression(0))
+            self._expect(':')
+            entries.append(self._parse_expression(0))
+        self._advance()
+        return AST_Dict(*entries)
+
+    def _parse_call(self, fun: AST, /) -> AST_FunctionCall:
+        self._expect('(')
+        args = []
+        kwonly = False
+        while not self._at(')'):
+            if self.token is None:
+                self._error()
+            token_type = self.token.type
+            if token_type == '*':
+                self._advance()
+                if self._at('*'):
+                    self._advance()
+                    args.append((self._parse_expression(0), _FUNARG_STARSTAREXP, None))
+                else:
+                    args.append((self._parse_expression(0), _FUNARG_STAREXP, None))
+            elif (token_type == 'ARGNAME' or token_type == 'STRING') and self._peek() is not None \
+                    and self.peeked.type == '=':
+                namebind = self._advance().value
+                self._advance()  # the '='
+                args.append((self._parse_expression(0), _FUNARG_NAMEVAL, namebind))
+            else:
+                args.append((self._parse_expression(0), _FUNARG_EXP, None))
+            # keyword arguments must come after positional arguments
+            if args[-1][1] is _FUNARG_STARSTAREXP or args[-1][1] is _FUNARG_NAMEVAL:
+                kwonly = True
+            elif kwonly:
+                raise CGParseException("Positional arguments must not follow keyword arguments")
+            if not self._at(')'):
+                self._expect(',')
+        self._advance()
+        return AST_FunctionCall(fun, args)
+
+    def _parse_declarg(self) -> tuple:
+        if self._at('*'):
+            self._advance()
+            if self._at('*'):
+                self._advance()
+                return self._expect('ARGNAME').value, _ARGTYPE_KWARGS, None
+            elif self._at('ARGNAME'):
+                return self._advance().value, _ARGTYPE_STARARG, None
+            return None, _ARGTYPE_STAR, None
+        name = self._expect('ARGNAME').value
+        if self._at('='):
+            self._advance()
+            return name, _ARGTYPE_DEFAULT, self._parse_expression(0)
+        return name, _ARGTYPE_NORMAL, None
+
+    def _parse_lambda(self) -> AST_Lambda:
+        self._expect('FUN')
+        self._expect('[')
+        args = []
+        if not self._at(']'):
+            args.append(self._parse_declarg())
+            while self._at(','):
+                self._advance()
+                args.append(self._parse_declarg())
+        self._expect(']')
+        _check_declarglist(args)
+        self._expect('(')
+        body = self._parse_expression(0)
+        self._expect(')')
+        return AST_Lambda(args, body)
+
+
+parser = _ExpressionParser()
+
+
+# parser keeps state during parsing, so we must not use it from several threads at once.
+_parser_lock: Final = threading.Lock()
+
+
+@lru_cache(maxsize=4096)
+def _parse_formula(formula: str, /) -> Union[AST, SyntaxError, CGParseException]:
+    """
+        Parses formula (without the leading =) into an AST or returns the exception for mis-parses.
+        Character sheets typically contain many copies of the same formula. Since ASTs are immutable, these can share
+        a single AST (including its compiled evaluator), so we cache the results.
+        Exceptions are cached without their traceback, which would keep the parser's frames alive.
+    """
+    try:
+        with _parser_lock:
+            return parser.parse(formula)
+    except (SyntaxError, CGParseException) as e:  # TODO: better error handling
+        return e.with_traceback(None)
+    except RecursionError:
+        # Should not happen due to _MAX_NESTING_DEPTH, unless we are called with a deep stack already.
+        return CGParseException("formula nested too deeply")
 
 
 def input_string_to_value(input_string: str, /) -> Union[int, float, str, AST, DataError, None]:
@@ -1293,19 +1970,21 @@ def input_string_to_value(input_string: str, /) -> Union[int, float, str, AST, D
         else:
             return input_string[1:]
     elif input_string[0] == '=':  # everything starting with = is a formula, with the = itself not part of it
-        try:
-            result = parser.parse(input_string[1:])
-        except (SyntaxError, CGParseException) as e:  # TODO: better error handling
-            result = DataError(exception=e)  # TODO: Capture exception? (very expensive)
-        return result
-    elif re_number_int.fullmatch(input_string):
-        return int(input_string)
-    elif re_number_float.fullmatch(input_string):
-        return float(input_string)
-    else:
-        return input_string
-
-
-# for debugging only.
+        result = _parse_formula(input_string[1:])
+        if isinstance(result, AST):
+            return result
+        return DataError(exception=result)  # Each mis-parsed input gets its own DataError object.
+    elif '0' <= input_string[0] <= '9':  # Numbers start with a digit. Most other inputs fail this cheap test.
+        # isascii() and isdigit() is equivalent to re_number_int.fullmatch, but much faster.
+        if input_string.isascii() and input_string.isdigit():
+            return int(input_string)
+        elif re_number_float.fullmatch(input_string):
+            return float(input_string)
+    return input_string
+
+
+# for debugging only: prints the tokens of each line of input.
 if __name__ == '__main__':
-    lex.runmain()
+    import sys
+    for line in sys.stdin:
+        print([(token.type, token.value) for token in _tokenize(line)])
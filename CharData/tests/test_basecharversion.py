@@ -85,3 +85,39 @@ class TestBaseCharVersion(unittest.TestCase):
         assert answer2['b.b.c.x'] == ('=$AUTO * $AUTO', True)
         answer3 = answer['get']
         assert answer3 == {'b.b.x': 25, 'b.x': 5, 'x.bb': True, 'b.b.d.x': 25}
+
+    def test_lookup_memo(self):
+        list_1 = CharDataSourceDict()
+        list_1.description = "desc1"
+        list_1.dict_type = "typeA"
+        cv = BaseCharVersion(data_sources=[list_1])
+        cv.bulk_set_input({'a': '=2', 'b': '=a * a', 'c': '=b + b + a', 'x.a': '=$AUTO + 1', 'y': '=x.a + a'}, where=0)
+        lookups = []
+        find_lookup = cv.find_lookup
+
+        def counting_find_lookup(query, *args, **kwargs):
+            lookups.append(query)
+            return find_lookup(query, *args, **kwargs)
+        cv.find_lookup = counting_find_lookup
+
+        assert cv.get('c') == 10
+        assert sorted(lookups) == ['a', 'b', 'c']  # every key is only looked up once.
+        assert cv.get('y') == 5
+        # The memo only lives during one (outermost) evaluation, so changes are seen immediately.
+        cv.set_input('a', '=3', where=0)
+        assert cv.get('c') == 21
+        assert cv.get('x.a') == 4
+
+    def test_lookup_candidates(self):
+        cv = BaseCharVersion(data_sources=[CharDataSourceDict(), CharDataSourceDict()])
+        assert list(cv.lookup_candidates('a.b.c', indices=[0, 1])) == \
+            [('a.b.c', 0), ('a.b.c', 1), ('a.b._all', 0), ('a.b._all', 1), ('a.c', 0), ('a.c', 1),
+             ('a._all', 0), ('a._all', 1), ('c', 0), ('c', 1), ('_all', 0), ('_all', 1)]
+        assert list(cv.lookup_candidates('abc', restricted=True, indices=[0])) == []
+        assert list(cv.lookup_candidates('_all', indices=[1])) == [('_all', 1)]
+        assert list(cv.lookup_candidates('a.__b__.c', indices=[1])) == [('a.__b__.c', 1), ('a.__b__._all', 1)]
+        assert list(cv.lookup_candidates('__a__.b.c', indices=[1])) == \
+            [('__a__.b.c', 1), ('__a__.b._all', 1), ('__a__.c', 1), ('__a__._all', 1)]
+        assert list(cv.lookup_candidates('a.b.__c__', indices=[1])) == [('a.b.__c__', 1), ('a.__c__', 1), ('__c__', 1)]
+        # Candidates are cached per query, so asking again must give the same answer.
+        assert list(cv.lookup_candidates('a.b.__c__', indices=[0])) == [('a.b.__c__', 0), ('a.__c__', 0), ('__c__', 0)]
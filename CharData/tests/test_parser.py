@@ -3,6 +3,8 @@ from CharData import Parser
 from CharData import BaseCharVersion
 from CharData import CharExceptions
 import unittest
+import copy
+import pickle
 
 
 class TestParser(unittest.TestCase):
@@ -23,6 +25,15 @@ class TestParser(unittest.TestCase):
         for keyword in Parser.keywords:
             assert keyword == keyword.upper()
 
+    # noinspection PyProtectedMember
+    def test_tokenizer(self):
+        assert [(t.type, t.value) for t in Parser._tokenize(" 1.5//'a' $b\t$Name attr.x <= LAMBDA ")] == \
+            [('FLOAT', 1.5), ('IDIV', '//'), ('STRING', 'a'), ('ARGNAME', 'b'), ('SPECIALARG', 'Name'),
+             ('LOOKUP', 'attr.x'), ('LTE', '<='), ('FUN', 'LAMBDA')]
+        for s in ["1 ! 2", "Ab", "1 +\u00a02", "'abc"]:
+            with self.assertRaises(SyntaxError):
+                list(Parser._tokenize(s))
+
     def test_add(self):
         t = self.p("1 + 5")
         assert self.ev(t) == 6
@@ -55,6 +66,21 @@ class TestParser(unittest.TestCase):
         t = self.p(" ((4+5)*3) ")
         assert self.ev(t) == 27
 
+    def test_deep_nesting(self):
+        # Brackets and operator chains are parsed without recursion.
+        assert self.evp('(' * 3000 + '1' + ')' * 3000) == 1
+        assert self.p(' + '.join(['$Name'] * 3000)).needs_env == {'Name'}
+        assert self.evp(' * '.join(['(1 + 1)'] * 30)) == 2 ** 30
+        # Other nested subexpressions are limited to a nesting depth of 200 (counting the whole formula).
+        n = 199
+        assert self.evp('[' * n + '1' + ']' * n)
+        assert self.evp('NOT ' * n + '1') is False
+        assert self.evp('{1: ' * n + '1' + '}' * n)
+        for s in ['[' * (n + 1) + '1' + ']' * (n + 1), 'NOT ' * (n + 1) + '1', 'f(' * (n + 1) + '1' + ')' * (n + 1),
+                  '[' * 3000 + '1' + ']' * 3000]:
+            e = Parser.input_string_to_value('=' + s)
+            assert isinstance(e, CharExceptions.DataError) and str(e.reason) == 'formula nested too deeply'
+
     # noinspection PyProtectedMember
     def test_variable(self):
         old = Parser._ALLOWED_SPECIAL_ARGS
@@ -127,6 +153,31 @@ class TestParser(unittest.TestCase):
         assert self.evp("COND(FALSE, 1/0, 'c')") == 'c'
         assert self.evp("IF 1==1 THEN 5 ELSE 4") == 5
         assert self.evp("IF FALSE THEN '5' ELSE '4'") == '4'
+        assert isinstance(self.p("COND(a.b == 1, 'a', 'b')"), Parser.AST_CondLit)
+        assert self.p("COND(1 == 1, 'a', 'b')").value == 'a'
+        assert isinstance(self.p("IF TRUE THEN a.b ELSE 1"), Parser.AST_Lookup)
+        with self.assertRaises(Parser.CGParseException):  # unbound variables are detected even in unused branches
+            self.p("IF TRUE THEN 1 ELSE $a")
+
+    def test_constant_folding(self):
+        t = self.p("2 * 3 + 1.5")
+        assert isinstance(t, Parser.AST_Literal) and t.value == 7.5
+        t = self.p("1 // 0")  # errors only happen upon evaluation
+        with self.assertRaises(ZeroDivisionError):
+            self.ev(t)
+        assert self.p("'a' + 'b' + 'c'[0]").value == 'abc'
+        assert self.p("'a' < 'b'").value is True
+        assert isinstance(self.p("'a' * 3"), Parser.AST_Mult)  # might be huge
+        for s in ["'a' < 1", "'abc'[5]", "1[0]"]:  # errors only happen upon evaluation
+            with self.assertRaises(Exception):
+                self.evp(s)
+        assert self.p("NOT 0").value is True
+        assert isinstance(self.p("TRUE AND a.b"), Parser.AST_Lookup)
+        assert isinstance(self.p("0 OR a.b"), Parser.AST_Lookup)
+        assert self.p("1 < 0 AND a.b").value is False
+        assert self.p("'x' OR a.b").value == 'x'
+        with self.assertRaises(Parser.CGParseException):  # unbound variables are detected even if never evaluated
+            self.p("FALSE AND $a")
 
     def test_modulo(self):
         assert self.evp("7 % 3") == 1
@@ -134,6 +185,18 @@ class TestParser(unittest.TestCase):
 
     def test_index(self):
         assert self.evp("'abcd'[1+1]") == 'c'
+        # indexing and function calls bind tighter than any operator.
+        assert self.evp("'ab' + 'cd'[0]") == 'abc'
+        assert self.evp("1 + FUN[$x]($x * 2)(3)") == 7
+        assert self.evp("NOT [0][0]") is True
+
+    def test_syntax_errors(self):
+        for s in ["", "1 2", "1 < 2 < 3", "1 == 2 != 3", "(1", "[1,,]", "{1: 2, 3}", "FUN[$a,]($a)", "f(,)", "NOT"]:
+            with self.assertRaises(Parser.CGParseException):
+                self.p(s)
+        with self.assertRaises(Parser.CGParseException):  # keyword argument before positional argument
+            self.p("FUN[$a, $b]($a)($b = 1, 2)")
+        assert self.evp("(1 < 2) == TRUE") is True
 
     def test_lambdas(self):
         assert self.evp("FUN[$a]($a+1)(2)") == 3
@@ -155,10 +218,100 @@ class TestParser(unittest.TestCase):
         assert f(0, 1) == [0, 1, 2, 3]
         assert f(0, 1, 10) == [0, 1, 10, 3]
 
+        assert self.evp("FUN[*$a]($a)()") == ()
+        assert self.evp("FUN[*$a]($a)(1)") == (1,)
+        assert self.evp("FUN[*$a]($a)(1, 2)") == (1, 2)
+        assert self.evp("FUN[*$a]($a)(1, 2, 3)") == (1, 2, 3)
+        f = self.evp("FUN[$a, $b = $a * 2, $c = $b + 1]([$a, $b, $c])")
+        assert f(1) == [1, 2, 3] and f(1, 5) == [1, 5, 6] and f(1, c=0) == [1, 2, 0]
+
+        # Defaults that do not depend on earlier arguments are evaluated only once, but not before they are needed.
+        assert Parser.parser.parse("FUN[$a, $b = 5, $c = $a, $d = $Name](1)").default_is_precomputable == \
+            (False, True, False, True)
+        f = self.evp("FUN[$a, $b = 1 // $a](FUN[$c, $d = $a * 2, $e = $c]([$c, $d, $e]))")
+        assert f(0, 1)(1, 2) == [1, 2, 1]
+        with self.assertRaises(ZeroDivisionError):
+            f(0)
+        g = f(2)
+        assert g(1) == [1, 4, 1]
+        assert g(3) == [3, 4, 3]
+
+        # Free variables are captured into the frame of the inner lambda, including the special $-variables.
+        nested = Parser.parser.parse("FUN[$a](FUN[$b](FUN[$a]([$a, $b, $Name])))")
+        assert nested.eval_ast(None, {'Name': 'x'})(1)(2)(3) == [3, 2, 'x']
+        with self.assertRaises(Parser.CGParseException):
+            Parser.parser.parse("GET($a)")
+
+    def test_interned_leaves(self):
+        t = Parser.parser.parse("a.b + a.b")
+        assert t.child[0] is t.child[1]
+        assert Parser.AST_Literal(1) is not Parser.AST_Literal(True)
+        # Both occurences of $a are the same object, but are passed differently.
+        assert self.evp("FUN[$a](FUN[*$r]($r)(*$a, $a))([1, 2])") == (1, 2, [1, 2])
+
+    def test_evaluator(self):
+        t = self.p("[1, {2: 'a'}, FUN[$a]($a + 1)(2)]")
+        assert t.evaluator is t.evaluator  # compiled only once
+        assert t.evaluator(None, {}) == [1, {2: 'a'}, 3]
+        assert not hasattr(copy.copy(t), '_evaluator')
+        assert not hasattr(t, '__dict__')  # ASTs use __slots__
+        f = self.evp("FUN[$a, $b = $a * 2](FUN[$c]([$a, $b, $c]))")
+        assert f(1)(3) == [1, 2, 3]
+        assert pickle.loads(pickle.dumps(t)).eval_ast(None, {}) == t.eval_ast(None, {})
+        # generated code is shared between formulas of the same shape
+        assert self.p("1 + 2 * $Name").evaluator.__code__ is self.p("'x' + 'y' * $Query").evaluator.__code__
+        deep = "0"
+        for i in range(120):  # more nested blocks than Python supports in a single function
+            deep = "IF $Name THEN (" + deep + ") + 1 ELSE 0"
+        assert self.p(deep).eval_ast(None, {'Name': True}) == 120
+        # long chains of operators are generated without recursion
+        assert self.p(' + '.join(['$Name'] * 3000)).eval_ast(None, {'Name': 1}) == 3000
+        nested = 'x'
+        for i in range(1000):
+            nested = [nested]
+        assert self.p('$Name' + '[0]' * 1000).eval_ast(None, {'Name': nested}) == 'x'
+        chain = self.p(' AND '.join(['$Name'] * 3000) + ' OR ' + ' OR '.join(['$Query'] * 3000))
+        assert chain.eval_ast(None, {'Name': 1, 'Query': 0}) == 1
+        assert chain.eval_ast(None, {'Name': [], 'Query': 'a'}) == 'a'
+        assert chain.eval_ast(None, {'Name': [], 'Query': ''}) == ''
+
+    def test_error_propagation(self):
+        class ErrorData:  # minimal stand-in for a BaseCharVersion where every lookup fails
+            # noinspection PyUnusedLocal
+            @staticmethod
+            def get(key, locator=None):
+                return CharExceptions.DataError('missing ' + key)
+
+        for s in ["a.b + 1", "1 - a.b", "NOT a.b", "COND(a.b, 1, 2)", "IF a.b THEN 1 ELSE x.y", "a.b AND 1",
+                  "[1, a.b]", "{1: a.b}", "{a.b}", "FUN[$x]($x)(a.b)", "FUN[$x, $y]($x)(1, a.b)",
+                  "FUN[$x, $y = a.b]($y)(1)", "FUN[$x]($x)($x = a.b)", "FUN[*$x]($x)(1, *a.b)"]:
+            result = self.p(s).eval_ast(ErrorData(), {})
+            assert isinstance(result, CharExceptions.DataError) and result.reason == 'missing a.b', s
+        # Subtrees nested deeper than _MAX_GENERATED_INDENT are evaluated by their own evaluators, whose results must
+        # be checked for errors, too.
+        for s in ["[a.b] AND 1", "(NOT a.b) AND 1", "{1: a.b} AND 1", "{a.b} AND 1"]:
+            s = "IF $Name THEN " * 49 + "$Name AND (" + s + ")" + " ELSE 0" * 49
+            result = self.p(s).eval_ast(ErrorData(), {'Name': True})
+            assert isinstance(result, CharExceptions.DataError) and result.reason == 'missing a.b', s
+
     def test_list(self):
         assert self.evp("[1]") == [1]
         assert self.evp("[1+1] + [2+2,]") == [2, 4]
 
+    def test_input_string_to_value(self):
+        assert Parser.input_string_to_value('') is None
+        assert Parser.input_string_to_value('"abc"') == 'abc'
+        assert Parser.input_string_to_value('12') == 12
+        assert Parser.input_string_to_value('1.5') == 1.5
+        for s in ['abc', '12a', '1.5.2', '1.', '-1', '\u00b2', '1\u00b2']:  # not numbers
+            assert Parser.input_string_to_value(s) == s
+        t = Parser.input_string_to_value('=FUN[$a]($a * 2)(a.b)')
+        assert isinstance(t, Parser.AST)
+        assert Parser.input_string_to_value('=FUN[$a]($a * 2)(a.b)') is t  # repeated formulas share their AST
+        e1 = Parser.input_string_to_value('=1 +')
+        e2 = Parser.input_string_to_value('=1 +')
+        assert isinstance(e1, CharExceptions.DataError) and e1 is not e2 and e1.reason == e2.reason
+
 # TODO: Refactor to unittest at some point. Postponed, because semantics of lookups may change anyway.
 def test_lookups(empty3cv: 'BaseCharVersion.BaseCharVersion'):
     # L1: BaseCharVersion.UserDataSet = empty3cv.lists[0]